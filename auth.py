@@ -0,0 +1,89 @@
+"""Password hashing and login checks.
+
+bcrypt is slow on purpose, so hashing runs in a small worker pool that caps
+how many hashes run at once instead of letting every request thread burn a
+core. The cost factor comes from the app's BCRYPT_ROUNDS config (or the
+BCRYPT_ROUNDS environment variable), and stored hashes made with a different
+cost are rehashed the next time their user logs in.
+"""
+
+import os
+import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, has_app_context
+from model import db, User
+
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+
+MAX_WORKERS = 4
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
+def get_rounds():
+    """Get the bcrypt cost factor new hashes should use."""
+
+    if has_app_context():
+        return current_app.config.get('BCRYPT_ROUNDS', BCRYPT_ROUNDS)
+
+    return BCRYPT_ROUNDS
+
+
+def hash_rounds(hashed):
+    """Get the cost factor of a bcrypt hash, or None if it isn't one."""
+
+    parts = hashed.split('$')
+
+    if len(parts) != 4 or not parts[2].isdigit():
+        return None
+
+    return int(parts[2])
+
+
+def hash_password(password, rounds=None):
+    """Hash a password with bcrypt in the worker pool."""
+
+    salt = bcrypt.gensalt(rounds or get_rounds())
+
+    return executor.submit(bcrypt.hashpw, password.encode('utf-8'), salt).result()
+
+
+def verify_password(password, hashed):
+    """Check a password against a stored hash in the worker pool."""
+
+    password = password.encode('utf-8')
+    hashed = hashed.encode('utf-8')
+
+    if hash_rounds(hashed) is None:
+        return False
+
+    return executor.submit(bcrypt.checkpw, password, hashed).result()
+
+
+def needs_rehash(hashed, rounds=None):
+    """Check if a stored hash was made with a different cost factor."""
+
+    return hash_rounds(hashed) != (rounds or get_rounds())
+
+
+def authenticate(email, password):
+    """Look up a user by email and check their password.
+
+    Returns (user, is_valid), with user None when there is no account. A
+    valid password stored with an outdated cost is rehashed and committed.
+    """
+
+    user = User.query.filter_by(email=email).first()
+
+    if not user or not password:
+        return user, False
+
+    if not verify_password(password, user.password):
+        return user, False
+
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.session.commit()
+
+    return user, True
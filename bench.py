@@ -0,0 +1,462 @@
+"""Benchmark the Flask routes against a generated dataset.
+
+Fills a database with synthetic cities, locals, restaurants and favorites
+lists, stubs out Yelp, Facebook and SendGrid, then times requests to the
+heavy routes and counts their queries:
+
+    python bench.py routes --users-per-city 2000 --output bench.json
+    python bench.py auth --rounds 12 --threads 8
+
+The database given with --db is wiped first, so point it at a scratch
+database (the default is a SQLite file in /tmp). Results include the git
+commit so runs can be compared across commits.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from urlparse import urlparse
+
+os.environ.setdefault('YELP_API_KEY', 'bench')
+os.environ.setdefault('FACEBOOK_ACCESS_TOKEN', 'bench')
+os.environ.setdefault('SENDGRID_API_KEY', 'bench')
+
+import bcrypt
+from sqlalchemy import event
+from server import app
+from model import *
+import auth
+import fbg
+import yelp_api
+import sendgrid
+from leaderboard import rebuild_city_restaurant_counts
+from locations import reload_locations
+from similarity import reset_similarity_index
+
+
+CITIES = [('SAN FRANCISCO', 'CA', 37.77, -122.42),
+          ('SEATTLE', 'WA', 47.61, -122.33),
+          ('NEW YORK', 'NY', 40.71, -74.01),
+          ('CHICAGO', 'IL', 41.88, -87.63),
+          ('AUSTIN', 'TX', 30.27, -97.74),
+          ('PORTLAND', 'OR', 45.52, -122.68)]
+
+CATEGORIES = [('Pizza', 'pizza'), ('Sushi Bars', 'sushi'), ('Mexican', 'mexican'),
+              ('Italian', 'italian'), ('Thai', 'thai'), ('Burgers', 'burgers'),
+              ('Ramen', 'ramen'), ('Bakeries', 'bakeries'), ('Coffee & Tea', 'coffee'),
+              ('Cocktail Bars', 'cocktailbars'), ('Seafood', 'seafood'),
+              ('Vietnamese', 'vietnamese'), ('Indian', 'indpak'), ('Korean', 'korean'),
+              ('French', 'french')]
+
+# share of each city's restaurants, at the unpopular end, that have no photos
+NO_PHOTO_SHARE = 0.1
+
+INSERT_CHUNK = 5000
+
+
+##############################################################################
+# Stubbed APIs
+
+class StubResponse(object):
+    """Canned HTTP response for the stub transports."""
+
+    def __init__(self, payload):
+        self.status_code = 200
+        self.ok = True
+        self.headers = {}
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class StubYelpTransport(object):
+    """Answers Yelp search and business requests from the generated data."""
+
+    def __init__(self, restaurants):
+        self.restaurants = restaurants
+        self.by_city = {}
+        for business in restaurants.values():
+            self.by_city.setdefault(business['location']['city'].upper(), []).append(business)
+
+    def request(self, method, url, **kwargs):
+        path = urlparse(url).path
+
+        if path == yelp_api.SEARCH_PATH:
+            city = kwargs['params']['location'].split(',')[0].replace('+', ' ').upper()
+            businesses = self.by_city.get(city, [])
+            limit = kwargs['params'].get('limit', 5)
+            return StubResponse({'businesses': random.sample(businesses, min(limit, len(businesses)))})
+
+        yelp_id = path[len(yelp_api.BUSINESS_PATH):]
+        return StubResponse(self.restaurants[yelp_id])
+
+
+class StubGraph(object):
+    """Facebook Graph API stub that finds no places."""
+
+    def request(self, path, args=None):
+        return {'data': []}
+
+
+##############################################################################
+# Synthetic data
+
+def insert_rows(table, rows):
+    """Insert dict rows into a table in chunks."""
+
+    for start in range(0, len(rows), INSERT_CHUNK):
+        db.session.execute(table.insert(), rows[start:start + INSERT_CHUNK])
+
+
+def popular_index(size):
+    """Pick an index in range(size) skewed toward the start of the range."""
+
+    return int(size * random.random() ** 3)
+
+
+def business_for(rest_id, row):
+    """Build a Yelp business payload for a generated restaurant."""
+
+    return {'id': row['yelp_id'],
+            'name': row['name'],
+            'url': row['yelp_url'],
+            'image_url': row['yelp_photo'],
+            'coordinates': {'latitude': row['lat'], 'longitude': row['lng']},
+            'categories': [{'title': row['yelp_category'], 'alias': row['yelp_alias']}],
+            'location': {'address1': row['address'],
+                         'city': row['city'],
+                         'state': row['state'],
+                         'display_address': [row['address']]},
+            'photos': ['https://example.com/{}/{}.jpg'.format(rest_id, i) for i in range(3)]}
+
+
+def generate_data(cities, users_per_city, favorites, restaurants):
+    """Fill the database with a synthetic dataset.
+
+    Returns dict of yelp_id to Yelp business payloads for the stub.
+    """
+
+    password = bcrypt.hashpw('password', bcrypt.gensalt(4))
+    per_city = restaurants // cities
+
+    insert_rows(ListCategory.__table__, [{'list_c_id': 1, 'category': 'favorites'},
+                                         {'list_c_id': 2, 'category': 'custom'}])
+
+    zipcode_rows = []
+    user_rows = []
+    profile_rows = []
+    list_rows = []
+    restaurant_rows = []
+    photo_rows = []
+    item_rows = []
+    businesses = {}
+
+    user_id = 0
+    rest_id = 0
+    item_id = 0
+
+    for city_index in range(cities):
+        if city_index < len(CITIES):
+            city, state, lat, lng = CITIES[city_index]
+        else:
+            city, state, lat, lng = 'CITY {}'.format(city_index), 'ZZ', 35.0 + city_index % 10, -90.0
+        zipcode = '9{:04d}'.format(city_index)
+
+        zipcode_rows.append({'zipcode': zipcode, 'city': city, 'state': state,
+                             'lat': lat, 'lng': lng})
+
+        city_rest_ids = []
+        for i in range(per_city):
+            rest_id += 1
+            category, alias = random.choice(CATEGORIES)
+            row = {'rest_id': rest_id,
+                   'name': '{} {} {}'.format(category, city.title(), i),
+                   'lat': lat + random.uniform(-0.05, 0.05),
+                   'lng': lng + random.uniform(-0.05, 0.05),
+                   'yelp_id': 'bench-{}'.format(rest_id),
+                   'yelp_url': 'https://www.yelp.com/biz/bench-{}'.format(rest_id),
+                   'yelp_category': category,
+                   'yelp_alias': alias,
+                   'yelp_photo': 'https://example.com/{}.jpg'.format(rest_id),
+                   'address': '{} Main St'.format(i),
+                   'city': city.title(),
+                   'state': state}
+            restaurant_rows.append(row)
+            businesses[row['yelp_id']] = business_for(rest_id, row)
+            city_rest_ids.append(rest_id)
+
+            if i < per_city * (1 - NO_PHOTO_SHARE):
+                for j in range(3):
+                    photo_rows.append({'rest_id': rest_id,
+                                       'url': 'https://example.com/{}/{}.jpg'.format(rest_id, j)})
+
+        for i in range(users_per_city):
+            user_id += 1
+            picked = set()
+            while len(picked) < min(favorites, per_city):
+                picked.add(city_rest_ids[popular_index(per_city)])
+
+            user_rows.append({'user_id': user_id,
+                              'email': 'user{}@example.com'.format(user_id),
+                              'password': password,
+                              'username': 'user{}'.format(user_id),
+                              'city': city,
+                              'state': state,
+                              'zipcode': zipcode,
+                              'favorites_count': len(picked)})
+            profile_rows.append({'user_id': user_id, 'image_fn': 'default.png'})
+            list_rows.append({'list_id': user_id, 'user_id': user_id,
+                              'name': 'favorites', 'status': 'draft', 'category_id': 1,
+                              'item_count': len(picked)})
+
+            for favorite in picked:
+                item_id += 1
+                item_rows.append({'item_id': item_id, 'list_id': user_id, 'rest_id': favorite})
+
+    for table, rows in [(Zipcode.__table__, zipcode_rows),
+                        (User.__table__, user_rows),
+                        (Profile.__table__, profile_rows),
+                        (List.__table__, list_rows),
+                        (Restaurant.__table__, restaurant_rows),
+                        (Photo.__table__, photo_rows),
+                        (ListItem.__table__, item_rows),
+                        (SiteCounter.__table__, [{'name': 'users', 'value': user_id}])]:
+        insert_rows(table, rows)
+
+    db.session.commit()
+
+    # serial ids were given explicitly, so move Postgres sequences past them
+    if db.engine.name == 'postgresql':
+        for table, column in [('users', 'user_id'), ('lists', 'list_id'),
+                              ('restaurants', 'rest_id'), ('list_items', 'item_id'),
+                              ('list_categories', 'list_c_id')]:
+            db.session.execute("SELECT setval(pg_get_serial_sequence('{0}', '{1}'), "
+                               "(SELECT MAX({1}) FROM {0}))".format(table, column))
+        db.session.commit()
+
+    rebuild_city_restaurant_counts()
+    reload_locations()
+    reset_similarity_index()
+
+    return businesses
+
+
+def enable_sqlite_foreign_keys():
+    """Make SQLite enforce foreign keys so list deletes cascade like Postgres."""
+
+    @event.listens_for(db.engine, 'connect')
+    def set_foreign_keys(dbapi_connection, connection_record):
+        dbapi_connection.execute('PRAGMA foreign_keys = ON')
+
+
+def reset_database():
+    """Drop and recreate every table."""
+
+    db.drop_all()
+    db.create_all()
+
+
+##############################################################################
+# Timing
+
+def percentile(values, share):
+    """Get the value below which share of sorted values fall."""
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(share * (len(values) - 1))))
+
+    return values[index]
+
+
+def login(client, user):
+    """Put a user in the test client's session."""
+
+    with client.session_transaction() as sess:
+        sess['user_id'] = user.user_id
+        sess['city'] = user.city
+        sess['state'] = user.state
+        sess['username'] = user.username
+
+
+def time_route(client, make_request, count):
+    """Time count requests and collect their query counts."""
+
+    make_request()
+
+    latencies = []
+    queries = []
+    errors = 0
+
+    for _ in range(count):
+        start = time.time()
+        response = make_request()
+        latencies.append(1000 * (time.time() - start))
+
+        queries.append(int(response.headers.get('X-Query-Count', 0)))
+        if response.status_code >= 400:
+            errors += 1
+
+    return {'requests': count,
+            'p50_ms': round(percentile(latencies, 0.5), 2),
+            'p95_ms': round(percentile(latencies, 0.95), 2),
+            'mean_queries': round(sum(queries) / float(count), 1),
+            'max_queries': max(queries),
+            'errors': errors}
+
+
+def bench_routes(count):
+    """Time the heavy routes, returning dict of route name to results."""
+
+    client = app.test_client()
+    users = User.query.all()
+    locations = db.session.query(User.state, User.city).distinct().all()
+    yelp_ids = [yelp_id for (yelp_id,) in db.session.query(Restaurant.yelp_id)]
+
+    def discover():
+        login(client, random.choice(users))
+        return client.get('/discover')
+
+    def city_page():
+        state, city = random.choice(locations)
+        return client.get('/cities/{}/{}'.format(state.lower(), city.lower()))
+
+    def restaurant_page():
+        login(client, random.choice(users))
+        return client.get('/restaurants/{}'.format(random.choice(yelp_ids)))
+
+    def list_items():
+        return client.get('/list-items.json?lst_id={}'.format(random.choice(users).user_id))
+
+    def homepage():
+        with client.session_transaction() as sess:
+            sess.clear()
+        return client.get('/')
+
+    routes = [('/', homepage),
+              ('/discover', discover),
+              ('/cities/<state>/<city>', city_page),
+              ('/restaurants/<yelp_id>', restaurant_page),
+              ('/list-items.json', list_items)]
+
+    return dict((name, time_route(client, make_request, count))
+                for name, make_request in routes)
+
+
+def git_commit():
+    """Get the current git commit, or None outside a checkout."""
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_routes(args):
+    """Generate a dataset, time the routes and report the results."""
+
+    random.seed(args.seed)
+
+    app.config['QUERY_STATS'] = True
+    connect_to_db(app, args.db)
+    if db.engine.name == 'sqlite':
+        enable_sqlite_foreign_keys()
+
+    start = time.time()
+    reset_database()
+    businesses = generate_data(args.cities, args.users_per_city,
+                               args.favorites, args.restaurants)
+    generated_in = time.time() - start
+
+    yelp_api.client.transport = StubYelpTransport(businesses)
+    fbg.graph = StubGraph()
+    sendgrid.dispatcher.transport = sendgrid.LocalSinkTransport()
+
+    results = {'commit': git_commit(),
+               'db': db.engine.name,
+               'dataset': {'cities': args.cities,
+                           'users_per_city': args.users_per_city,
+                           'favorites': args.favorites,
+                           'restaurants': args.restaurants,
+                           'generated_in_s': round(generated_in, 1)},
+               'routes': bench_routes(args.requests)}
+
+    for name, route in sorted(results['routes'].items()):
+        print "{:<26} p50 {:>8.1f} ms  p95 {:>8.1f} ms  queries {:>6.1f} (max {})  errors {}".format(
+            name, route['p50_ms'], route['p95_ms'], route['mean_queries'],
+            route['max_queries'], route['errors'])
+
+    return results
+
+
+def run_auth(args):
+    """Time concurrent password checks through the auth worker pool."""
+
+    hashed = auth.hash_password('password', args.rounds)
+    latencies = []
+    lock = threading.Lock()
+
+    def check_passwords(count):
+        for _ in range(count):
+            start = time.time()
+            auth.verify_password('password', hashed)
+            with lock:
+                latencies.append(1000 * (time.time() - start))
+
+    threads = [threading.Thread(target=check_passwords, args=(args.logins // args.threads,))
+               for _ in range(args.threads)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    results = {'commit': git_commit(),
+               'auth': {'rounds': args.rounds,
+                        'threads': args.threads,
+                        'workers': auth.MAX_WORKERS,
+                        'logins': len(latencies),
+                        'logins_per_s': round(len(latencies) / elapsed, 1),
+                        'p50_ms': round(percentile(latencies, 0.5), 2),
+                        'p95_ms': round(percentile(latencies, 0.95), 2)}}
+
+    print "{logins} logins at cost {rounds} from {threads} threads: {logins_per_s} logins/s, " \
+          "p50 {p50_ms} ms, p95 {p95_ms} ms".format(**results['auth'])
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the app.')
+    parser.add_argument('--db', default='sqlite:////tmp/lola_bench.db',
+                        help='database URI; it is wiped before the run')
+    parser.add_argument('--output', help='file to write JSON results to')
+    parser.add_argument('--seed', type=int, default=0)
+    commands = parser.add_subparsers(dest='command')
+
+    routes = commands.add_parser('routes', help='time the heavy routes')
+    routes.add_argument('--cities', type=int, default=3)
+    routes.add_argument('--users-per-city', type=int, default=1000)
+    routes.add_argument('--favorites', type=int, default=25)
+    routes.add_argument('--restaurants', type=int, default=10000)
+    routes.add_argument('--requests', type=int, default=50)
+    routes.set_defaults(run=run_routes)
+
+    logins = commands.add_parser('auth', help='time password checks')
+    logins.add_argument('--rounds', type=int, default=auth.BCRYPT_ROUNDS)
+    logins.add_argument('--threads', type=int, default=8)
+    logins.add_argument('--logins', type=int, default=200)
+    logins.set_defaults(run=run_auth)
+
+    args = parser.parse_args()
+    results = args.run(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,82 @@
+"""Small in-process caches shared by the helper modules."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache whose entries expire after ttl seconds.
+
+    A ttl of None keeps entries until they are evicted or cleared. Hits and
+    misses are counted so they can be reported.
+    """
+
+    def __init__(self, max_size=128, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get a cached value, or default if it is missing or expired."""
+
+        with self._lock:
+            entry = self._data.pop(key, None)
+
+            if entry is None or (entry[1] is not None and entry[1] < time.time()):
+                self.misses += 1
+                return default
+
+            # re-insert so the most recently used keys are evicted last
+            self._data[key] = entry
+            self.hits += 1
+
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """Get a cached value like get, without counting a hit or miss."""
+
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None or (entry[1] is not None and entry[1] < time.time()):
+                return default
+
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Cache a value, evicting the least recently used if full."""
+
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove a key from the cache if present."""
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove every entry from the cache."""
+
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return dict of hit and miss counts and current size."""
+
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._data),
+                    'max_size': self.max_size}
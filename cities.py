@@ -2,17 +2,43 @@
 
 from model import *
 from sqlalchemy import func
+from leaderboard import get_top_restaurants
+from locations import get_city_location
+from cache import TTLCache
+
+
+CITIES_CACHE_TTL = 300
+
+PHOTOS_PER_RESTAURANT = 3
+LOCALS_PER_PAGE = 60
+
+cities_cache = TTLCache(max_size=1, ttl=CITIES_CACHE_TTL)
 
 
 def get_cities():
     """Get distinct cities and states for which at least one user exists."""
 
+    location_list = cities_cache.get('locations')
+
+    if location_list is None:
+        location_list = load_cities()
+        cities_cache.set('locations', location_list)
+
+    return location_list
+
+
+def load_cities():
+    """Get city, state, lat and lng dicts for every city with a local.
+
+    Runs a single query; coordinates come from the in-memory location lookup.
+    """
+
     all_locations = db.session.query(User.city, User.state).distinct().all()
 
     location_list = []
 
     for city, state in all_locations:
-        location_obj = get_city_lat_lng(state, city)
+        location_obj = get_city_location(state, city)
         location_dict = {'city': city,
                          'state': state,
                          'lat': location_obj.lat,
@@ -22,6 +48,25 @@ def get_cities():
     return location_list
 
 
+def is_new_city(state, city):
+    """Check if a city is missing from the cached cities.
+
+    Also returns True when nothing is cached, since then it can't be ruled out.
+    Peeks at the cache, so signups don't skew its hit and miss counts.
+    """
+
+    location_list = cities_cache.peek('locations')
+
+    if location_list is None:
+        return True
+
+    for location in location_list:
+        if location['state'] == state and location['city'] == city:
+            return False
+
+    return True
+
+
 def get_users_by_city(state, city):
     """Get all users for a specific city and state."""
 
@@ -37,32 +82,87 @@ def check_city_state(state, city):
 
     return (User.query.filter(User.state == state.upper(),
                               User.city == city.upper())
-                      .all())
+                      .first())
 
 
 def count_restaurants_by_city(state, city):
     """Get top 10 restaurants for a specific city."""
 
-    # query to get Restaurant object and count
-    restaurants = (db.session.query(Restaurant, func.count(ListItem.rest_id))
-                             .join(ListItem)
-                             .join(List)
-                             .join(User)
-                             .filter(User.state == state.upper(),
-                                     User.city == city.upper(),
-                                     List.category_id == 1)
-                             .group_by(Restaurant.rest_id)
-                             .order_by(db.desc(func.count(ListItem.rest_id)), Restaurant.name)
-                             .limit(10).all())
+    return get_top_restaurants(state.upper(), city.upper())
+
+
+def get_restaurant_photos(rest_ids, per_restaurant=PHOTOS_PER_RESTAURANT):
+    """Get dict of rest_id to its first few photo urls, in one query."""
 
-    return restaurants
+    if not rest_ids:
+        return {}
+
+    rank = (func.row_number().over(partition_by=Photo.rest_id,
+                                   order_by=Photo.photo_id)
+                             .label('rank'))
+
+    ranked = (db.session.query(Photo.rest_id, Photo.url, rank)
+                        .filter(Photo.rest_id.in_(rest_ids))
+                        .subquery())
+
+    rows = (db.session.query(ranked.c.rest_id, ranked.c.url)
+                      .filter(ranked.c.rank <= per_restaurant)
+                      .order_by(ranked.c.rest_id, ranked.c.rank))
+
+    photos = {}
+    for rest_id, url in rows:
+        photos.setdefault(rest_id, []).append(url)
+
+    return photos
+
+
+def get_top_restaurant_rows(state, city):
+    """Get the city's top 10 restaurants as dicts with their photo urls."""
+
+    top = count_restaurants_by_city(state, city)
+    photos = get_restaurant_photos([restaurant.rest_id for restaurant, count in top])
+
+    return [{'yelp_id': restaurant.yelp_id,
+             'name': restaurant.name,
+             'lat': restaurant.lat,
+             'lng': restaurant.lng,
+             'yelp_url': restaurant.yelp_url,
+             'favorites': count,
+             'photos': photos.get(restaurant.rest_id, [])}
+            for restaurant, count in top]
+
+
+def get_locals_page(state, city, page=1, per_page=LOCALS_PER_PAGE):
+    """Get one page of a city's locals as dicts, and whether there are more."""
+
+    rows = (db.session.query(User.username, Profile.image_fn)
+                      .outerjoin(Profile)
+                      .filter(User.state == state.upper(),
+                              User.city == city.upper())
+                      .order_by(User.username)
+                      .offset((page - 1) * per_page)
+                      .limit(per_page + 1)
+                      .all())
+
+    locals_ = [{'username': username, 'image_fn': image_fn or 'default.png'}
+               for username, image_fn in rows[:per_page]]
+
+    return locals_, len(rows) > per_page
+
+
+def get_city_page(state, city, page=1):
+    """Get everything the city page shows in a fixed number of queries."""
+
+    locals_, has_next = get_locals_page(state, city, page)
+
+    return {'restaurants': get_top_restaurant_rows(state, city),
+            'locals': locals_,
+            'page': page,
+            'has_next': has_next,
+            'location': get_city_lat_lng(state, city)}
 
 
 def get_city_lat_lng(state, city):
     """Get lat and lng coordinates for a city."""
 
-    location = (Zipcode.query.filter(Zipcode.city == city.upper(),
-                                     Zipcode.state == state.upper())
-                             .first())
-
-    return location
+    return get_city_location(state.upper(), city.upper())
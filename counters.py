@@ -0,0 +1,83 @@
+"""Denormalized counts that let pages gate features without counting rows.
+
+users.favorites_count, lists.item_count and the 'users' site counter change
+in the same transaction as the rows they count. reconcile_counts() recomputes
+them all in case anything drifted, and is meant to run periodically:
+
+    python counters.py
+"""
+
+from model import *
+from sqlalchemy import func, select, and_
+
+
+USERS = 'users'
+
+
+def increment_counter(name, by=1):
+    """Add to a site counter without committing."""
+
+    updated = (SiteCounter.query.filter_by(name=name)
+                                .update({SiteCounter.value: SiteCounter.value + by},
+                                        synchronize_session=False))
+
+    if not updated:
+        db.session.add(SiteCounter(name=name, value=by))
+
+
+def get_counter(name):
+    """Get the value of a site counter, or 0 if it was never set."""
+
+    return db.session.query(SiteCounter.value).filter_by(name=name).scalar() or 0
+
+
+def change_favorites_count(user_id, by):
+    """Add to a user's favorites count without committing."""
+
+    (User.query.filter(User.user_id == user_id)
+               .update({User.favorites_count: User.favorites_count + by},
+                       synchronize_session=False))
+
+
+def reconcile_counts():
+    """Recompute every denormalized count from the rows it counts.
+
+    Returns dict of how many users and lists had drifted, and the user count.
+    """
+
+    users = User.__table__
+    lists = List.__table__
+
+    favorites = (select([func.count(ListItem.item_id)])
+                 .where(and_(ListItem.list_id == List.list_id,
+                             List.user_id == users.c.user_id,
+                             List.category_id == 1))
+                 .as_scalar())
+
+    items = (select([func.count(ListItem.item_id)])
+             .where(ListItem.list_id == lists.c.list_id)
+             .as_scalar())
+
+    fixed_users = db.session.execute(users.update()
+                                          .where(users.c.favorites_count != favorites)
+                                          .values(favorites_count=favorites)).rowcount
+
+    fixed_lists = db.session.execute(lists.update()
+                                          .where(lists.c.item_count != items)
+                                          .values(item_count=items)).rowcount
+
+    user_count = db.session.query(func.count(User.user_id)).scalar()
+    SiteCounter.query.filter_by(name=USERS).delete(synchronize_session=False)
+    db.session.add(SiteCounter(name=USERS, value=user_count))
+
+    db.session.commit()
+
+    return {'users': fixed_users, 'lists': fixed_lists, 'user_count': user_count}
+
+
+if __name__ == "__main__":
+    from server import app
+
+    connect_to_db(app)
+
+    print "Reconciled counts: {}".format(reconcile_counts())
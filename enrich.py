@@ -0,0 +1,137 @@
+"""Helper functions to store and enrich hot and new restaurants for /discover."""
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from model import db, Restaurant
+from search_index import index_restaurant
+import fbg as fb
+
+
+MAX_WORKERS = 4
+
+# seconds the page waits on Facebook lookups before rendering without them
+LOOKUP_WAIT = 3
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+
+def restaurant_from_business(item):
+    """Create Restaurant object from a Yelp search result."""
+
+    return Restaurant(name=item['name'],
+                      lat=item['coordinates']['latitude'],
+                      lng=item['coordinates']['longitude'],
+                      yelp_id=item['id'],
+                      yelp_url=item['url'].split('?')[0],
+                      yelp_category=item['categories'][0]['title'],
+                      yelp_alias=item['categories'][0]['alias'],
+                      yelp_photo=item['image_url'],
+                      address=item['location']['address1'],
+                      city=item['location']['city'],
+                      state=item['location']['state'])
+
+
+def save_businesses(businesses, retry=True):
+    """Get Restaurant objects for Yelp results, adding any new ones.
+
+    New restaurants are flushed but not committed, so the caller can read
+    them before committing everything in one transaction.
+    """
+
+    yelp_ids = [item['id'] for item in businesses]
+
+    restaurants = {}
+    if yelp_ids:
+        restaurants = {rest.yelp_id: rest for rest in
+                       Restaurant.query.filter(Restaurant.yelp_id.in_(yelp_ids)).all()}
+
+    new_restaurants = []
+    for item in businesses:
+        if item['id'] not in restaurants:
+            rest_obj = restaurant_from_business(item)
+            restaurants[item['id']] = rest_obj
+            new_restaurants.append(rest_obj)
+
+    if new_restaurants:
+        db.session.add_all(new_restaurants)
+
+        try:
+            db.session.flush()
+        except IntegrityError:
+            if not retry:
+                raise
+
+            # another request saved some of these first, so use its rows
+            db.session.rollback()
+            return save_businesses(businesses, retry=False)
+
+    return [restaurants[yelp_id] for yelp_id in yelp_ids]
+
+
+def lookup_ig_loc_id(app, rest_id, name, lat, lng, address):
+    """Get Instagram location id from Facebook and store it on the restaurant.
+
+    Runs on a worker thread, so it stores the result itself in case the page
+    has already rendered.
+    """
+
+    ig_loc_id = fb.request(name, lat, lng, address=address)
+
+    if ig_loc_id:
+        with app.app_context():
+            (Restaurant.query.filter(Restaurant.rest_id == rest_id,
+                                     Restaurant.ig_loc_id.is_(None))
+                             .update({Restaurant.ig_loc_id: ig_loc_id},
+                                     synchronize_session=False))
+            db.session.commit()
+
+    return ig_loc_id
+
+
+def get_hot_and_new(businesses):
+    """Get restaurant dicts for Yelp results with Instagram location ids.
+
+    Facebook lookups for restaurants missing an id run concurrently and the
+    page waits at most LOOKUP_WAIT seconds; lookups still running keep going
+    in the background and are saved when they finish.
+    """
+
+    restaurants = save_businesses(businesses)
+    app = current_app._get_current_object()
+
+    hot_and_new = []
+    to_lookup = []
+    to_index = []
+
+    for rest_obj in restaurants:
+        rest_dict = rest_obj.to_dict()
+        to_index.append((rest_obj.rest_id, rest_dict))
+
+        if not rest_obj.ig_loc_id:
+            to_lookup.append((rest_dict, rest_obj.rest_id))
+
+        hot_and_new.append(rest_dict)
+
+    # commit before starting lookups so the new rows exist for the workers
+    db.session.commit()
+
+    for rest_id, rest_dict in to_index:
+        index_restaurant(rest_id, rest_dict)
+
+    lookups = {}
+    for rest_dict, rest_id in to_lookup:
+        future = executor.submit(lookup_ig_loc_id, app, rest_id,
+                                 rest_dict['rest_name'],
+                                 rest_dict['lat'],
+                                 rest_dict['lng'],
+                                 rest_dict['address'])
+        lookups[future] = rest_dict
+
+    done, pending = wait(lookups, timeout=LOOKUP_WAIT)
+
+    for future in done:
+        if not future.exception():
+            lookups[future]['ig_loc_id'] = future.result()
+
+    return hot_and_new
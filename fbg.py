@@ -2,15 +2,42 @@ import requests
 import facebook
 import os
 import urllib3
+from geo import best_match
 
 API_KEY = os.environ['FACEBOOK_ACCESS_TOKEN']
 
-graph = facebook.GraphAPI(access_token=API_KEY)
+# seconds before a Graph API request gives up
+TIMEOUT = 5
 
+graph = facebook.GraphAPI(access_token=API_KEY, timeout=TIMEOUT)
 
-def request(query, lat, lng, distance='1600'):
+
+def search_places(query, lat, lng, distance='1600'):
+    """Get candidate places near a point from the Facebook Graph API."""
+
+    data = graph.request('/search', args={'q': query,
+                                          'type': 'place',
+                                          'center': '{},{}'.format(lat, lng),
+                                          'distance': distance,
+                                          'fields': 'id,name,location'})
+
+    places = []
+    for place in data['data']:
+        location = place.get('location', {})
+        places.append({'id': place['id'],
+                       'name': place.get('name'),
+                       'lat': location.get('latitude'),
+                       'lng': location.get('longitude'),
+                       'address': location.get('street'),
+                       'city': location.get('city')})
+
+    return places
+
+
+def request(query, lat, lng, distance='1600', address=None):
     """Get location ID for a place by querying Facebook Graph API."""
 
-    data = graph.request('/search?q=' + query + '&type=place&center=' + lat + ',' + lng + '&distance=' + distance)
-    if data['data']:
-        return data['data'][0]['id']
+    place = best_match(search_places(query, lat, lng, distance),
+                       query, lat, lng, address)
+    if place:
+        return place['id']
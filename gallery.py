@@ -0,0 +1,92 @@
+"""Restaurant photo galleries stored from Instagram and Yelp.
+
+Instagram photos are kept once found. Yelp photos are saved with the time
+they were fetched. Once they are older than YELP_PHOTOS_TTL the page keeps
+serving them while a 'yelp_photos' job refreshes them in the background.
+
+A restaurant whose Yelp fetch failed or found no photos gets a 'yelp_photos'
+job instead, and views within EMPTY_GALLERY_RETRY of that job don't ask Yelp
+again.
+"""
+
+from datetime import datetime, timedelta
+from model import *
+from yelp_api import business
+
+
+YELP_PHOTOS_TTL = timedelta(days=7)
+EMPTY_GALLERY_RETRY = timedelta(days=1)
+
+
+def save_yelp_photos(rest_id, urls):
+    """Replace a restaurant's Yelp photos with urls."""
+
+    (Photo.query.filter(Photo.rest_id == rest_id, Photo.source == 'yelp')
+                .delete(synchronize_session=False))
+
+    fetched_at = datetime.utcnow()
+    db.session.bulk_insert_mappings(Photo, [{'rest_id': rest_id,
+                                             'url': url,
+                                             'source': 'yelp',
+                                             'fetched_at': fetched_at}
+                                            for url in urls])
+    db.session.commit()
+
+
+def fetch_yelp_photos(rest_id):
+    """Get a restaurant's photos from Yelp and store them."""
+
+    restaurant = Restaurant.query.get(rest_id)
+    results = business(restaurant.yelp_id)
+
+    if 'error' in results:
+        raise RuntimeError('Yelp business lookup failed: {}'.format(results['error']))
+
+    urls = results.get('photos', [])
+    save_yelp_photos(rest_id, urls)
+
+    return urls
+
+
+def fetched_recently(rest_id):
+    """Check if a 'yelp_photos' job was queued for a restaurant lately."""
+
+    since = datetime.utcnow() - EMPTY_GALLERY_RETRY
+
+    return db.session.query(Job.query.filter(Job.kind == 'yelp_photos',
+                                             Job.rest_id == rest_id,
+                                             Job.created_at > since)
+                                     .exists()).scalar()
+
+
+def get_gallery(restaurant):
+    """Get (photo urls, whether they need refreshing) for a restaurant.
+
+    A restaurant with no stored photos has its Yelp photos fetched now,
+    unless a job already tried lately.
+    """
+
+    photos = (db.session.query(Photo.url, Photo.source, Photo.fetched_at)
+                        .filter(Photo.rest_id == restaurant.rest_id)
+                        .order_by(Photo.photo_id)
+                        .all())
+
+    instagram = [url for url, source, fetched_at in photos if source == 'instagram']
+    if instagram:
+        return instagram, False
+
+    if not photos:
+        if fetched_recently(restaurant.rest_id):
+            return [], False
+
+        try:
+            urls = fetch_yelp_photos(restaurant.rest_id)
+        except RuntimeError:
+            urls = []
+
+        # nothing found, so the queued job marks when Yelp was last asked
+        return urls, not urls
+
+    oldest = min(fetched_at for url, source, fetched_at in photos)
+
+    return [url for url, source, fetched_at in photos], oldest < datetime.utcnow() - YELP_PHOTOS_TTL
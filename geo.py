@@ -0,0 +1,151 @@
+"""Helper functions to match Facebook and Instagram places to restaurants."""
+
+import re
+from difflib import SequenceMatcher
+from math import radians, degrees, sin, cos, asin, sqrt
+from unicodedata import normalize
+
+
+EARTH_RADIUS_M = 6371000
+
+# candidates farther than this from the restaurant are never matched
+MATCH_RADIUS_M = 250
+
+# lowest score that still counts as a match
+MIN_SCORE = 0.6
+
+# score at which a match is good enough to stop looking at more candidates
+STRONG_SCORE = 0.85
+
+NAME_WEIGHT = 0.5
+DISTANCE_WEIGHT = 0.3
+ADDRESS_WEIGHT = 0.2
+
+ABBREVIATIONS = {'street': 'st',
+                 'avenue': 'ave',
+                 'boulevard': 'blvd',
+                 'road': 'rd',
+                 'drive': 'dr',
+                 'place': 'pl',
+                 'lane': 'ln',
+                 'court': 'ct',
+                 'square': 'sq',
+                 'suite': 'ste',
+                 'north': 'n',
+                 'south': 's',
+                 'east': 'e',
+                 'west': 'w',
+                 '&': 'and'}
+
+STOP_WORDS = set(['the', 'restaurant', 'cafe', 'bar'])
+
+
+def to_float(value):
+    """Convert a coordinate to float, or None if it can't be."""
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Get distance in meters between two lat/lng points."""
+
+    lat1, lng1, lat2, lng2 = map(radians, [lat1, lng1, lat2, lng2])
+
+    a = (sin((lat2 - lat1) / 2) ** 2 +
+         cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_M * asin(sqrt(a))
+
+
+def bounding_box(lat, lng, radius):
+    """Get (min_lat, max_lat, min_lng, max_lng) around a point.
+
+    Every point within radius meters is inside the box, so the box can be
+    used with an index to narrow down candidates before exact distances.
+    """
+
+    lat_delta = degrees(float(radius) / EARTH_RADIUS_M)
+    lng_delta = lat_delta / max(cos(radians(lat)), 0.01)
+
+    return lat - lat_delta, lat + lat_delta, lng - lng_delta, lng + lng_delta
+
+
+def normalize_text(text):
+    """Lowercase, strip accents and punctuation, and abbreviate street words."""
+
+    if not text:
+        return ''
+
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'ignore')
+
+    text = normalize('NFKD', text).encode('ascii', 'ignore').lower()
+    text = text.replace('&', ' & ')
+    words = re.findall(r"[a-z0-9&]+", text.replace("'", ''))
+
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+def text_similarity(a, b, stop_words=()):
+    """Get similarity between 0 and 1 of two names or addresses."""
+
+    a_words = [word for word in normalize_text(a).split() if word not in stop_words]
+    b_words = [word for word in normalize_text(b).split() if word not in stop_words]
+
+    if not a_words or not b_words:
+        return 0.0
+
+    overlap = len(set(a_words) & set(b_words)) / float(len(set(a_words) | set(b_words)))
+    ratio = SequenceMatcher(None, ' '.join(a_words), ' '.join(b_words)).ratio()
+
+    return max(overlap, ratio)
+
+
+def score_candidate(candidate, name, lat, lng, address=None, radius=MATCH_RADIUS_M):
+    """Score a candidate place against a restaurant, or None if out of range.
+
+    Candidates are dicts with name, lat and lng, and optionally address.
+    """
+
+    lat, lng = to_float(lat), to_float(lng)
+    candidate_lat = to_float(candidate.get('lat'))
+    candidate_lng = to_float(candidate.get('lng'))
+
+    if None in (lat, lng, candidate_lat, candidate_lng):
+        return None
+
+    distance = haversine(lat, lng, candidate_lat, candidate_lng)
+
+    if distance > radius:
+        return None
+
+    score = (NAME_WEIGHT * text_similarity(name, candidate.get('name'), STOP_WORDS) +
+             DISTANCE_WEIGHT * (1 - distance / radius))
+
+    if address and candidate.get('address'):
+        score += ADDRESS_WEIGHT * text_similarity(address, candidate['address'])
+    else:
+        # without an address to compare, only name and distance count
+        score /= NAME_WEIGHT + DISTANCE_WEIGHT
+
+    return score
+
+
+def best_match(candidates, name, lat, lng, address=None,
+               radius=MATCH_RADIUS_M, min_score=MIN_SCORE):
+    """Get the highest scoring candidate within radius, or None."""
+
+    best = None
+    best_score = None
+
+    for candidate in candidates:
+        score = score_candidate(candidate, name, lat, lng, address, radius)
+
+        if score is not None and score >= min_score and (best is None or score > best_score):
+            best = candidate
+            best_score = score
+
+    return best
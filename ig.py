@@ -1,85 +1,163 @@
-import os
 import re
-from model import db, Photo, Restaurant
-import json
 import subprocess
+from contextlib import contextmanager
+from itertools import islice
+from urlparse import urlparse
+from model import db, Photo, Restaurant
 import fbg as fb
+from geo import best_match, STRONG_SCORE
+
+
+# number of photos to keep per restaurant
+PHOTO_LIMIT = 6
+
+# number of posts to look through for PHOTO_LIMIT jpgs before giving up
+POST_LIMIT = 50
+
+# REGEX PATTERNS FOR instagram-scraper --search-location OUTPUT:
+LOCATION_PATTERNS = {'loc_id': re.compile(r"\blocation-id: (.+?)(?=,)"),
+                     'address': re.compile(r"\bsubtitle: (.+?)(?=,)"),
+                     'city': re.compile(r"\bcity: (.+?)(?=,)"),
+                     'lat': re.compile(r"\blat: (.+?)(?=, lng)"),
+                     'lng': re.compile(r"\blng: (\S*)")}
+
+NAME_PATTERN = re.compile(r"\btitle: (.+?)(?=, subtitle)")
+
+
+@contextmanager
+def scraper_output(args):
+    """Run instagram-scraper and yield its stdout lines as they are printed.
+
+    The scraper is stopped on exit, so callers can stop reading as soon as
+    they have what they need.
+    """
+
+    p = subprocess.Popen(['instagram-scraper'] + args, stdout=subprocess.PIPE)
+
+    try:
+        yield iter(p.stdout.readline, '')
+    finally:
+        if p.poll() is None:
+            p.terminate()
+        p.stdout.close()
+        p.wait()
+
+
+def parse_location_line(line):
+    """Get dict of location fields from a line of search output, or None."""
+
+    location = {}
+
+    for field, pattern in LOCATION_PATTERNS.items():
+        match = pattern.search(line)
+        if not match:
+            return None
+        location[field] = match.group(1).strip()
+
+    name = NAME_PATTERN.search(line)
+    location['name'] = name.group(1).strip() if name else None
+
+    return location
 
 
 def get_instagram_location(rest_id, rest_name, rest_lat, rest_lng, rest_address, rest_city):
     """Get Instagram Location ID based on restaurant name and Yelp lat/lng."""
 
-    #############################################
-    # SUBPROCESS TO RUN COMMAND AND READ OUTPUT #
-    #############################################
-
-    loc_id = fb.request(rest_name, rest_lat, rest_lng)
+    loc_id = fb.request(rest_name, rest_lat, rest_lng, address=rest_address)
     if loc_id:
         return loc_id
 
-    else:
-        string = 'instagram-scraper --search-location ' + rest_address + ' ' + rest_name
-        p = subprocess.Popen(string, stdout=subprocess.PIPE, shell=True)  # TAKE OUT shell=True
+    query = ' '.join(filter(None, [rest_address, rest_name]))
 
-        # REGEX PATTERNS:
-        latPattern = re.compile(r"\b(lat: )(.+?)(?=, lng)")
-        lngPattern = re.compile(r"\b(lng: )(.*)")
-        locIdPattern = re.compile(r"\b(location-id: )(.+?)(?=,)")
-        addressPattern = re.compile(r"\b(subtitle: )(.+?)(?=,)")
-        cityPattern = re.compile(r"\b(city: )(.+?)(?=,)")
+    # READ STDOUT LINE BY LINE, SCORING EACH LOCATION AGAINST THE YELP NAME,
+    # LAT / LNG AND ADDRESS, AND STOP THE SCRAPER AT THE FIRST STRONG MATCH
+    candidates = []
+    with scraper_output(['--search-location'] + query.split()) as lines:
+        for line in lines:
+            location = parse_location_line(line)
 
-        # LOOP TO READ LINE BY LINE OF STDOUT AND DETERMINE IF THERE IS A LAT / LNG
-        # MATCH TO THE YELP LAT / LNG
-        while True:
-            line = p.stdout.readline()
-            if line != '':
-                lat = latPattern.search(line)
-                lng = lngPattern.search(line)
-                locId = locIdPattern.search(line)
-                address = addressPattern.search(line)
-                city = cityPattern.search(line)
+            if location:
+                candidates.append(location)
 
-                if (lat.group(2) == rest_lat and lng.group(2) == rest_lng) or (address.group(2) == rest_address and city.group(2) == rest_city):
+                if best_match([location], rest_name, rest_lat, rest_lng,
+                              rest_address, min_score=STRONG_SCORE):
+                    break
 
-                    restaurant = Restaurant.query.filter_by(rest_id=rest_id).first()
-                    restaurant.ig_loc_id = locId.group(2)
-                    db.session.commit()
-                    return locId.group(2)
+    location = best_match(candidates, rest_name, rest_lat, rest_lng, rest_address)
 
-                elif (address.group(2) == rest_address or city.group(2) == rest_city):
+    if location:
+        restaurant = Restaurant.query.filter_by(rest_id=rest_id).first()
+        restaurant.ig_loc_id = location['loc_id']
+        db.session.commit()
+        return location['loc_id']
 
-                    restaurant = Restaurant.query.filter_by(rest_id=rest_id).first()
-                    restaurant.ig_loc_id = locId.group(2)
-                    db.session.commit()
-                    return locId.group(2)
 
-            else:
-                break
+def iter_location_posts(location):
+    """Yield posts for an Instagram location, newest first, page by page.
+
+    Uses instagram-scraper as a library so posts can be read as each page
+    arrives instead of waiting for the whole scrape to be written to disk.
+    """
+
+    from instagram_scraper.app import InstagramScraper
+
+    scraper = InstagramScraper(usernames=[location], location=True,
+                               media_types=['none'], media_metadata=True,
+                               quiet=True)
+    scraper.authenticate_as_guest()
+
+    return scraper.query_location_gen(location)
+
+
+def get_post_url(post):
+    """Get image URL for a scraped post."""
+
+    urls = post.get('urls') or [post.get('display_url')]
+
+    return urls[0]
+
+
+def is_jpg(url):
+    """Check if a URL points to a jpg, ignoring any query string."""
+
+    return bool(url) and urlparse(url).path.endswith('jpg')
 
 
 # this function scrapes instagram for a specific location ID and creates records
 # in the photos table with the returned URLs.
 def get_instagram_photos(rest_id, location):
-    """"""
+    """Store the first PHOTO_LIMIT jpgs posted at an Instagram location."""
 
-    os.system('instagram-scraper --location ' + location + ' --maximum 6 --media-metadata --media-types none --destination ig_photos')
+    urls = (get_post_url(post) for post in
+            islice(iter_location_posts(location), POST_LIMIT))
+    jpgs = list(islice((url for url in urls if is_jpg(url)), PHOTO_LIMIT))
 
-    # try with subprocess:
-    # string = 'instagram-scraper --location ' + location + ' --maximum 4 --media-metadata --media-types none --destination ig_photos'
-    # p = subprocess.Popen(string, stdout=subprocess.PIPE, shell=True)  # TAKE OUT shell=True
-    # p.terminate()
+    db.session.bulk_insert_mappings(Photo, [{'rest_id': rest_id,
+                                             'url': url,
+                                             'source': 'instagram'}
+                                            for url in jpgs])
+    db.session.commit()
 
-    json_file = 'ig_photos/' + location + '.json'
+    return 'success'
 
-    with open(json_file) as json_data:
-        results = json.load(json_data)
-        for result in results:
-            url = result['urls'][0]
-            if url[-3:] == 'jpg':
-                photo = Photo(rest_id=rest_id, url=url)
-                db.session.add(photo)
-                db.session.commit()
 
-    os.system('rm ig_photos/' + location + '.json')
+def fetch_instagram_data(rest_id):
+    """Find Instagram location for a restaurant and store its photos."""
 
-    return 'success'
+    restaurant = Restaurant.query.get(rest_id)
+
+    if restaurant.ig_loc_id:
+        return None
+
+    loc_id = get_instagram_location(restaurant.rest_id,
+                                    restaurant.name,
+                                    restaurant.lat,
+                                    restaurant.lng,
+                                    restaurant.address,
+                                    restaurant.city)
+
+    if loc_id:
+        restaurant.ig_loc_id = loc_id
+        db.session.commit()
+
+        return get_instagram_photos(restaurant.rest_id, loc_id)
@@ -0,0 +1,171 @@
+"""Background job queue and the worker process that runs it.
+
+Web requests only add rows to the jobs table with enqueue_job. Run
+
+    python jobs.py --concurrency 2
+
+to start a worker that claims queued jobs, runs them and retries failures.
+"""
+
+import argparse
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from model import *
+from ig import fetch_instagram_data
+from gallery import fetch_yelp_photos
+
+
+MAX_ATTEMPTS = 3
+
+# seconds before retrying a failed job, doubled after each attempt
+RETRY_DELAY = 60
+
+# seconds after which a running job is assumed to belong to a dead worker
+LEASE = 600
+
+POLL_INTERVAL = 2
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+HANDLERS = {'instagram': fetch_instagram_data,
+            'yelp_photos': fetch_yelp_photos}
+
+
+def get_active_job(kind, rest_id):
+    """Get queued or running job of a kind for a restaurant."""
+
+    return Job.query.filter(Job.kind == kind,
+                            Job.rest_id == rest_id,
+                            Job.status.in_(ACTIVE_STATUSES)).first()
+
+
+def get_latest_job(kind, rest_id):
+    """Get most recent job of a kind for a restaurant."""
+
+    return (Job.query.filter_by(kind=kind, rest_id=rest_id)
+                     .order_by(db.desc(Job.job_id))
+                     .first())
+
+
+def enqueue_job(kind, rest_id):
+    """Queue a job, or return the one already queued for that restaurant."""
+
+    job = get_active_job(kind, rest_id)
+
+    if job:
+        return job
+
+    job = Job(kind=kind, rest_id=rest_id)
+    db.session.add(job)
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another request queued the same job first
+        db.session.rollback()
+        job = get_active_job(kind, rest_id)
+
+    return job
+
+
+def claim_job():
+    """Mark the next runnable job as running and return it, or None."""
+
+    now = datetime.utcnow()
+    abandoned = now - timedelta(seconds=LEASE)
+
+    job = (Job.query.filter(db.or_(db.and_(Job.status == 'queued',
+                                           Job.run_after <= now),
+                                   db.and_(Job.status == 'running',
+                                           Job.updated_at < abandoned)))
+                    .order_by(Job.run_after)
+                    .with_for_update(skip_locked=True)
+                    .first())
+
+    if not job:
+        db.session.rollback()
+        return None
+
+    job.status = 'running'
+    job.attempts += 1
+    db.session.commit()
+
+    return job
+
+
+def run_job(job):
+    """Run a claimed job and record whether it succeeded."""
+
+    try:
+        HANDLERS[job.kind](job.rest_id)
+
+    except Exception:
+        db.session.rollback()
+        job.error = traceback.format_exc()
+
+        if job.attempts < MAX_ATTEMPTS:
+            job.status = 'queued'
+            job.run_after = (datetime.utcnow() +
+                             timedelta(seconds=RETRY_DELAY * 2 ** (job.attempts - 1)))
+        else:
+            job.status = 'failed'
+
+    else:
+        job.status = 'done'
+        job.error = None
+
+    db.session.commit()
+
+    return job.status
+
+
+def work(app, stop):
+    """Claim and run jobs until stop is set."""
+
+    with app.app_context():
+        while not stop.is_set():
+            job = claim_job()
+
+            if job:
+                run_job(job)
+            else:
+                stop.wait(POLL_INTERVAL)
+
+            db.session.remove()
+
+
+def run_worker(app, concurrency=2):
+    """Run jobs on concurrency threads until interrupted."""
+
+    stop = threading.Event()
+    threads = [threading.Thread(target=work, args=(app, stop))
+               for _ in range(concurrency)]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop.set()
+
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    from server import app
+
+    parser = argparse.ArgumentParser(description='Run queued background jobs.')
+    parser.add_argument('--concurrency', type=int, default=2,
+                        help='number of jobs to run at once')
+    args = parser.parse_args()
+
+    connect_to_db(app)
+    print "Worker started with concurrency {}".format(args.concurrency)
+    run_worker(app, args.concurrency)
@@ -0,0 +1,116 @@
+"""Materialized favorites counts per city used for top 10s and rankings."""
+
+from model import *
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+
+def increment_city_count(state, city, rest_id):
+    """Count one more local favorite for a restaurant in a city.
+
+    Does not commit, so the count changes in the same transaction as the
+    list item itself.
+    """
+
+    # one statement, so two first favorites at once can't both try to insert
+    table = CityRestaurantCount.__table__
+    db.session.execute(insert(table)
+                       .values(state=state, city=city, rest_id=rest_id, count=1)
+                       .on_conflict_do_update(index_elements=['state', 'city', 'rest_id'],
+                                              set_={'count': table.c['count'] + 1}))
+
+
+def decrement_city_counts(counts):
+    """Take favorites out of city counts without committing.
+
+    counts maps (state, city, rest_id) to how many favorites to remove. All
+    of them are updated in one statement, then emptied counts are deleted.
+    """
+
+    if not counts:
+        return
+
+    keys = db.tuple_(CityRestaurantCount.state,
+                     CityRestaurantCount.city,
+                     CityRestaurantCount.rest_id).in_(list(counts))
+
+    by = db.case([(db.and_(CityRestaurantCount.state == state,
+                           CityRestaurantCount.city == city,
+                           CityRestaurantCount.rest_id == rest_id), count)
+                  for (state, city, rest_id), count in counts.items()])
+
+    (CityRestaurantCount.query.filter(keys)
+                              .update({CityRestaurantCount.count: CityRestaurantCount.count - by},
+                                      synchronize_session=False))
+    (CityRestaurantCount.query.filter(keys, CityRestaurantCount.count <= 0)
+                              .delete(synchronize_session=False))
+
+
+def get_top_restaurants(state, city, limit=10):
+    """Get (Restaurant, count) tuples for the most favorited in a city."""
+
+    return (db.session.query(Restaurant, CityRestaurantCount.count)
+                      .join(CityRestaurantCount)
+                      .filter(CityRestaurantCount.state == state,
+                              CityRestaurantCount.city == city)
+                      .order_by(db.desc(CityRestaurantCount.count), Restaurant.name)
+                      .limit(limit)
+                      .all())
+
+
+def get_city_rank(yelp_id, state, city):
+    """Get position of a restaurant in its city's favorites, or None."""
+
+    mine = (db.session.query(CityRestaurantCount.count, Restaurant.name)
+                      .join(Restaurant)
+                      .filter(CityRestaurantCount.state == state,
+                              CityRestaurantCount.city == city,
+                              Restaurant.yelp_id == yelp_id)
+                      .first())
+
+    if not mine:
+        return None
+
+    count, name = mine
+
+    ahead = (db.session.query(func.count(CityRestaurantCount.rest_id))
+                       .join(Restaurant)
+                       .filter(CityRestaurantCount.state == state,
+                               CityRestaurantCount.city == city,
+                               db.or_(CityRestaurantCount.count > count,
+                                      db.and_(CityRestaurantCount.count == count,
+                                              Restaurant.name < name)))
+                       .scalar())
+
+    return ahead + 1
+
+
+def rebuild_city_restaurant_counts():
+    """Recompute every city's favorites counts from the list items."""
+
+    counts = (db.session.query(User.state,
+                               User.city,
+                               ListItem.rest_id,
+                               func.count(ListItem.item_id))
+                        .select_from(User)
+                        .join(List)
+                        .join(ListItem)
+                        .filter(List.category_id == 1)
+                        .group_by(User.state, User.city, ListItem.rest_id))
+
+    table = CityRestaurantCount.__table__
+
+    db.session.query(CityRestaurantCount).delete(synchronize_session=False)
+    db.session.execute(table.insert().from_select(['state', 'city', 'rest_id', 'count'],
+                                                  counts.statement))
+    db.session.commit()
+
+    return CityRestaurantCount.query.count()
+
+
+if __name__ == "__main__":
+    from server import app
+
+    connect_to_db(app)
+
+    print "Rebuilt {} city restaurant counts".format(rebuild_city_restaurant_counts())
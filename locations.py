@@ -0,0 +1,132 @@
+"""In-memory lookup of zipcodes and city coordinates.
+
+Zipcode data is static once seeded, so it is loaded once per process instead
+of querying the zipcodes table on every signup, zipcode check and map. The
+lookups aren't shared between processes, so restart the web servers after
+reseeding the table; reload_locations() only refreshes the calling process.
+"""
+
+import csv
+import os
+import threading
+from collections import namedtuple
+
+from model import db, Zipcode
+
+
+ZIPCODES_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'zipcodes.csv')
+
+Location = namedtuple('Location', ['zipcode', 'city', 'state', 'lat', 'lng'])
+
+_zipcodes = {}
+_cities = {}
+_loaded = False
+_lock = threading.Lock()
+
+
+def load_locations_from_db():
+    """Get every zipcode in the zipcodes table as Location tuples."""
+
+    rows = (db.session.query(Zipcode.zipcode, Zipcode.city, Zipcode.state,
+                             Zipcode.lat, Zipcode.lng)
+                      .order_by(Zipcode.zipcode)
+                      .all())
+
+    return [Location(*row) for row in rows]
+
+
+def parse_location_row(row):
+    """Get Location for a zipcodes CSV row, or None if the row isn't valid."""
+
+    if len(row) != 5:
+        return None
+
+    zipcode, city, state, lat, lng = [field.strip() for field in row]
+
+    if not (zipcode.isdigit() and len(zipcode) <= 5):
+        return None
+
+    if not city or not (len(state) == 2 and state.isalpha()):
+        return None
+
+    try:
+        lat = float(lat)
+        lng = float(lng)
+    except ValueError:
+        return None
+
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+
+    return Location(zipcode, city.upper(), state.upper(), lat, lng)
+
+
+def read_locations_csv(path=ZIPCODES_CSV):
+    """Stream a zipcodes CSV, yielding a Location per row or None if invalid.
+
+    The header row, when there is one, is skipped.
+    """
+
+    with open(path) as f:
+        reader = csv.reader(f)
+
+        for line_number, row in enumerate(reader):
+            if line_number == 0 and row and not row[0].strip().isdigit():
+                continue
+
+            if row:
+                yield parse_location_row(row)
+
+
+def load_locations_from_csv(path=ZIPCODES_CSV):
+    """Get every valid zipcode in the zipcodes CSV as Location tuples."""
+
+    return [location for location in read_locations_csv(path) if location]
+
+
+def reload_locations():
+    """Rebuild the lookups from the zipcodes table, or the CSV if it's empty."""
+
+    global _loaded
+
+    locations = load_locations_from_db() or load_locations_from_csv()
+
+    zipcodes = {}
+    cities = {}
+
+    for location in locations:
+        zipcodes[location.zipcode] = location
+        cities.setdefault((location.state, location.city), location)
+
+    with _lock:
+        _zipcodes.clear()
+        _zipcodes.update(zipcodes)
+        _cities.clear()
+        _cities.update(cities)
+        _loaded = True
+
+    return len(zipcodes)
+
+
+def _ensure_loaded():
+    """Load the lookups on first use."""
+
+    if not _loaded:
+        reload_locations()
+
+
+def get_zipcode(zipcode):
+    """Get Location for a zipcode, or None if it isn't a valid zipcode."""
+
+    _ensure_loaded()
+
+    return _zipcodes.get(zipcode)
+
+
+def get_city_location(state, city):
+    """Get a Location with lat and lng for a city, or None if unknown."""
+
+    _ensure_loaded()
+
+    return _cities.get((state, city))
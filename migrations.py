@@ -0,0 +1,251 @@
+"""Versioned schema changes for databases created before the models changed.
+
+db.create_all() builds a new database straight from model.py, so mark it as
+up to date with `stamp`. On an existing database, run db.create_all() first
+to add any new tables; changes to existing tables are then brought forward
+with `upgrade` and can be rolled back with `downgrade`:
+
+    python migrations.py status
+    python migrations.py stamp
+    python migrations.py upgrade [version]
+    python migrations.py downgrade <version>
+"""
+
+import argparse
+from collections import namedtuple
+from model import *
+from auth import hash_password, hash_rounds
+
+
+Migration = namedtuple('Migration', ['version', 'description', 'upgrade', 'downgrade'])
+
+
+def hash_plain_text_passwords():
+    """Hash passwords stored in plain text the same way signups do."""
+
+    rows = db.session.execute("SELECT user_id, password FROM users").fetchall()
+
+    for user_id, password in rows:
+        if hash_rounds(password) is None:
+            db.session.execute("UPDATE users SET password = :password WHERE user_id = :user_id",
+                               {'password': hash_password(password), 'user_id': user_id})
+
+
+MIGRATIONS = [
+    Migration(1, 'numeric coordinates with lat/lng index',
+              upgrade=["DELETE FROM zipcodes WHERE zipcode = 'ZIP_CODE'",
+                       """ALTER TABLE restaurants
+                            ALTER COLUMN lat TYPE DOUBLE PRECISION USING NULLIF(lat, '')::DOUBLE PRECISION,
+                            ALTER COLUMN lng TYPE DOUBLE PRECISION USING NULLIF(lng, '')::DOUBLE PRECISION""",
+                       """ALTER TABLE zipcodes
+                            ALTER COLUMN lat TYPE DOUBLE PRECISION USING NULLIF(lat, '')::DOUBLE PRECISION,
+                            ALTER COLUMN lng TYPE DOUBLE PRECISION USING NULLIF(lng, '')::DOUBLE PRECISION""",
+                       "CREATE INDEX ix_restaurants_lat_lng ON restaurants (lat, lng)"],
+              downgrade=["DROP INDEX ix_restaurants_lat_lng",
+                         """ALTER TABLE zipcodes
+                              ALTER COLUMN lat TYPE VARCHAR(128) USING lat::TEXT,
+                              ALTER COLUMN lng TYPE VARCHAR(128) USING lng::TEXT""",
+                         """ALTER TABLE restaurants
+                              ALTER COLUMN lat TYPE VARCHAR(128) USING lat::TEXT,
+                              ALTER COLUMN lng TYPE VARCHAR(128) USING lng::TEXT"""]),
+
+    Migration(2, 'indexes for hot join paths, unique yelp_id and list items',
+              upgrade=[# point everything at the oldest copy of a duplicated restaurant
+                       """CREATE TEMPORARY TABLE duplicate_restaurants ON COMMIT DROP AS
+                            SELECT r.rest_id, keep.rest_id AS keep_id
+                            FROM restaurants r
+                            JOIN (SELECT yelp_id, MIN(rest_id) AS rest_id
+                                  FROM restaurants
+                                  GROUP BY yelp_id) keep
+                              ON r.yelp_id = keep.yelp_id AND r.rest_id <> keep.rest_id""",
+                       """UPDATE list_items SET rest_id = d.keep_id
+                            FROM duplicate_restaurants d WHERE list_items.rest_id = d.rest_id""",
+                       """UPDATE photos SET rest_id = d.keep_id
+                            FROM duplicate_restaurants d WHERE photos.rest_id = d.rest_id""",
+                       """DELETE FROM jobs USING duplicate_restaurants d
+                            WHERE jobs.rest_id = d.rest_id""",
+                       """DELETE FROM city_restaurant_counts USING duplicate_restaurants d
+                            WHERE city_restaurant_counts.rest_id = d.rest_id""",
+                       """DELETE FROM restaurants USING duplicate_restaurants d
+                            WHERE restaurants.rest_id = d.rest_id""",
+                       """DELETE FROM list_items a USING list_items b
+                            WHERE a.list_id = b.list_id
+                              AND a.rest_id = b.rest_id
+                              AND a.item_id > b.item_id""",
+                       # merged restaurants and removed duplicates change the counts
+                       "DELETE FROM city_restaurant_counts",
+                       """INSERT INTO city_restaurant_counts (state, city, rest_id, count)
+                            SELECT users.state, users.city, list_items.rest_id, COUNT(list_items.item_id)
+                            FROM users
+                            JOIN lists ON lists.user_id = users.user_id
+                            JOIN list_items ON list_items.list_id = lists.list_id
+                            WHERE lists.category_id = 1
+                            GROUP BY users.state, users.city, list_items.rest_id""",
+                       "CREATE UNIQUE INDEX uq_restaurants_yelp_id ON restaurants (yelp_id)",
+                       "CREATE UNIQUE INDEX uq_list_items_list_id_rest_id ON list_items (list_id, rest_id)",
+                       "CREATE INDEX ix_list_items_rest_id ON list_items (rest_id)",
+                       "CREATE INDEX ix_lists_user_id_category_id ON lists (user_id, category_id)",
+                       "CREATE INDEX ix_users_state_city ON users (state, city)",
+                       "CREATE INDEX ix_profiles_user_id ON profiles (user_id)",
+                       "CREATE INDEX ix_photos_rest_id ON photos (rest_id)"],
+              downgrade=["DROP INDEX ix_photos_rest_id",
+                         "DROP INDEX ix_profiles_user_id",
+                         "DROP INDEX ix_users_state_city",
+                         "DROP INDEX ix_lists_user_id_category_id",
+                         "DROP INDEX ix_list_items_rest_id",
+                         "DROP INDEX uq_list_items_list_id_rest_id",
+                         "DROP INDEX uq_restaurants_yelp_id"]),
+
+    Migration(3, 'delete list items with their list',
+              upgrade=["ALTER TABLE list_items DROP CONSTRAINT list_items_list_id_fkey",
+                       """ALTER TABLE list_items ADD CONSTRAINT list_items_list_id_fkey
+                            FOREIGN KEY (list_id) REFERENCES lists (list_id) ON DELETE CASCADE"""],
+              downgrade=["ALTER TABLE list_items DROP CONSTRAINT list_items_list_id_fkey",
+                         """ALTER TABLE list_items ADD CONSTRAINT list_items_list_id_fkey
+                              FOREIGN KEY (list_id) REFERENCES lists (list_id)"""]),
+
+    Migration(4, 'item count per list',
+              upgrade=["ALTER TABLE lists ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0",
+                       """UPDATE lists SET item_count = (SELECT COUNT(*) FROM list_items
+                                                         WHERE list_items.list_id = lists.list_id)"""],
+              downgrade=["ALTER TABLE lists DROP COLUMN item_count"]),
+
+    Migration(5, 'favorites count per user and user counter',
+              upgrade=["ALTER TABLE users ADD COLUMN favorites_count INTEGER NOT NULL DEFAULT 0",
+                       """UPDATE users SET favorites_count = (SELECT COUNT(list_items.item_id)
+                                                              FROM lists
+                                                              JOIN list_items ON list_items.list_id = lists.list_id
+                                                              WHERE lists.user_id = users.user_id
+                                                                AND lists.category_id = 1)""",
+                       "DELETE FROM counters WHERE name = 'users'",
+                       "INSERT INTO counters (name, value) SELECT 'users', COUNT(*) FROM users"],
+              downgrade=["DELETE FROM counters WHERE name = 'users'",
+                         "ALTER TABLE users DROP COLUMN favorites_count"]),
+
+    Migration(6, 'photo source and fetch time',
+              upgrade=["""ALTER TABLE photos
+                            ADD COLUMN source VARCHAR(32) NOT NULL DEFAULT 'instagram',
+                            ADD COLUMN fetched_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()"""],
+              downgrade=["""ALTER TABLE photos
+                              DROP COLUMN fetched_at,
+                              DROP COLUMN source"""]),
+
+    # logins only accept bcrypt hashes, so hash any password stored in plain
+    # text; there is nothing to undo on downgrade
+    Migration(7, 'hash plain text passwords',
+              upgrade=[hash_plain_text_passwords],
+              downgrade=[]),
+]
+
+LATEST = MIGRATIONS[-1].version
+
+
+def ensure_version_table():
+    """Create the table recording which migrations have been applied."""
+
+    db.session.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                              version INTEGER PRIMARY KEY,
+                              description VARCHAR(256) NOT NULL,
+                              applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)""")
+    db.session.commit()
+
+
+def get_current_version():
+    """Get highest applied migration version, or 0 if none."""
+
+    ensure_version_table()
+
+    return db.session.execute("SELECT MAX(version) FROM schema_migrations").scalar() or 0
+
+
+def record_version(migration):
+    """Mark a migration as applied without committing."""
+
+    db.session.execute("INSERT INTO schema_migrations (version, description) VALUES (:version, :description)",
+                       {'version': migration.version,
+                        'description': migration.description})
+
+
+def run_statements(statements):
+    """Execute SQL statements, or call functions, rolling back if any fail."""
+
+    try:
+        for statement in statements:
+            if callable(statement):
+                statement()
+            else:
+                db.session.execute(statement)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def upgrade(target=LATEST):
+    """Apply each migration after the current version up to target.
+
+    Each migration runs in its own transaction, so a failure leaves the
+    database at the last version that succeeded.
+    """
+
+    current = get_current_version()
+    applied = []
+
+    for migration in MIGRATIONS:
+        if current < migration.version <= target:
+            run_statements(migration.upgrade)
+            record_version(migration)
+            db.session.commit()
+            applied.append(migration.version)
+
+    return applied
+
+
+def downgrade(target):
+    """Undo each applied migration after target, newest first."""
+
+    current = get_current_version()
+    undone = []
+
+    for migration in reversed(MIGRATIONS):
+        if target < migration.version <= current:
+            run_statements(migration.downgrade)
+            db.session.execute("DELETE FROM schema_migrations WHERE version = :version",
+                               {'version': migration.version})
+            db.session.commit()
+            undone.append(migration.version)
+
+    return undone
+
+
+def stamp(target=LATEST):
+    """Mark migrations up to target as applied without running them."""
+
+    current = get_current_version()
+
+    for migration in MIGRATIONS:
+        if current < migration.version <= target:
+            record_version(migration)
+
+    db.session.commit()
+
+
+if __name__ == "__main__":
+    from server import app
+
+    parser = argparse.ArgumentParser(description='Apply or roll back schema changes.')
+    parser.add_argument('command', choices=['status', 'stamp', 'upgrade', 'downgrade'])
+    parser.add_argument('version', type=int, nargs='?')
+    args = parser.parse_args()
+
+    connect_to_db(app)
+
+    if args.command == 'upgrade':
+        print "Applied", upgrade(LATEST if args.version is None else args.version)
+    elif args.command == 'downgrade':
+        if args.version is None:
+            parser.error('downgrade needs a target version')
+        print "Rolled back", downgrade(args.version)
+    elif args.command == 'stamp':
+        stamp(LATEST if args.version is None else args.version)
+
+    print "Schema version {} (latest {})".format(get_current_version(), LATEST)
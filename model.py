@@ -3,6 +3,8 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask
 from unicodedata import normalize
+from datetime import datetime
+import bcrypt
 
 # This is the connection to the PostgreSQL database; we're getting this through
 # the Flask-SQLAlchemy helper library. On this, we can find the `session`
@@ -26,6 +28,10 @@ class User(db.Model):
     city = db.Column(db.String(64), nullable=False)
     state = db.Column(db.String(64), nullable=False)
     zipcode = db.Column(db.String(64), nullable=False)
+    # items in the user's favorites list, kept current by the list item helpers
+    favorites_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (db.Index('ix_users_state_city', 'state', 'city'),)
 
     def __repr__(self):
         """Provide helpful representation of user."""
@@ -52,6 +58,8 @@ class Profile(db.Model):
 
     user = db.relationship('User', backref='profiles')
 
+    __table_args__ = (db.Index('ix_profiles_user_id', 'user_id'),)
+
     def to_dict(self):
         """Return dict of profile info."""
 
@@ -81,10 +89,15 @@ class List(db.Model):
     status = db.Column(db.String(64), nullable=False)
     category_id = db.Column(db.Integer,
                             db.ForeignKey('list_categories.list_c_id'))
+    # kept in step with list_items by add_list_item and delete_list_items
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     user = db.relationship('User', backref='lists')
     list_category = db.relationship('ListCategory', backref='lists')
 
+    __table_args__ = (db.Index('ix_lists_user_id_category_id',
+                               'user_id', 'category_id'),)
+
     def to_dict(self):
         """Return dict of list."""
 
@@ -120,16 +133,24 @@ class ListItem(db.Model):
 
     item_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     list_id = db.Column(db.Integer,
-                        db.ForeignKey('lists.list_id'),
+                        db.ForeignKey('lists.list_id', ondelete='CASCADE'),
                         nullable=False)
     rest_id = db.Column(db.Integer,
                         db.ForeignKey('restaurants.rest_id'),
                         nullable=False)
     ordinal = db.Column(db.Integer)
 
-    lst = db.relationship('List', backref='list_items')
+    # deleting a list deletes its items in the database
+    lst = db.relationship('List', backref=db.backref('list_items',
+                                                     cascade='all, delete-orphan',
+                                                     passive_deletes=True))
     restaurant = db.relationship('Restaurant', backref='list_items')
 
+    # a restaurant can only be on a list once
+    __table_args__ = (db.Index('uq_list_items_list_id_rest_id',
+                               'list_id', 'rest_id', unique=True),
+                      db.Index('ix_list_items_rest_id', 'rest_id'))
+
     def to_dict(self):
         """Return dict of list item."""
 
@@ -154,8 +175,8 @@ class Restaurant(db.Model):
 
     rest_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
     name = db.Column(db.String(128), nullable=False)
-    lat = db.Column(db.String(128), nullable=False)
-    lng = db.Column(db.String(128), nullable=False)
+    lat = db.Column(db.Float, nullable=False)
+    lng = db.Column(db.Float, nullable=False)
     yelp_id = db.Column(db.String(128))
     yelp_url = db.Column(db.String(256))
     yelp_category = db.Column(db.String(128))
@@ -166,6 +187,10 @@ class Restaurant(db.Model):
     ig_loc_id = db.Column(db.String(256))
     yelp_alias = db.Column(db.String(128))
 
+    # bounding box lookups for nearby restaurants
+    __table_args__ = (db.Index('ix_restaurants_lat_lng', 'lat', 'lng'),
+                      db.Index('uq_restaurants_yelp_id', 'yelp_id', unique=True))
+
     def to_dict(self):
         """Return dict of list item."""
 
@@ -188,6 +213,49 @@ class Restaurant(db.Model):
         return "<Rest id={} name={}>".format(self.rest_id, normalize('NFKD', self.name).encode('ascii', 'ignore'))
 
 
+class CityRestaurantCount(db.Model):
+    """Number of times locals of a city have favorited a restaurant.
+
+    Kept current by the list item add/delete helpers; see leaderboard.py.
+    """
+
+    __tablename__ = 'city_restaurant_counts'
+
+    state = db.Column(db.String(64), primary_key=True)
+    city = db.Column(db.String(64), primary_key=True)
+    rest_id = db.Column(db.Integer,
+                        db.ForeignKey('restaurants.rest_id'),
+                        primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    restaurant = db.relationship('Restaurant')
+
+    __table_args__ = (db.Index('ix_city_restaurant_counts_rank',
+                               'state', 'city', 'count'),)
+
+    def __repr__(self):
+        """Provide helpful representation of city restaurant count."""
+
+        return "<{}, {} rest_id={} count={}>".format(self.city,
+                                                     self.state,
+                                                     self.rest_id,
+                                                     self.count)
+
+
+class SiteCounter(db.Model):
+    """Named site-wide count, like the number of users; see counters.py."""
+
+    __tablename__ = 'counters'
+
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        """Provide helpful representation of counter."""
+
+        return "<Counter {}={}>".format(self.name, self.value)
+
+
 class Zipcode(db.Model):
     """Table for converting zipcodes to other location info."""
 
@@ -196,8 +264,8 @@ class Zipcode(db.Model):
     zipcode = db.Column(db.String(128), primary_key=True)
     city = db.Column(db.String(128))
     state = db.Column(db.String(128))
-    lat = db.Column(db.String(128))
-    lng = db.Column(db.String(128))
+    lat = db.Column(db.Float)
+    lng = db.Column(db.Float)
 
 
 class Photo(db.Model):
@@ -210,13 +278,66 @@ class Photo(db.Model):
                         db.ForeignKey('restaurants.rest_id'),
                         nullable=False)
     url = db.Column(db.String(512))
+    # 'instagram' or 'yelp'; Yelp photos are refreshed when fetched_at is old
+    source = db.Column(db.String(32), nullable=False, default='instagram',
+                       server_default='instagram')
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
+                           server_default=db.func.now())
 
     restaurant = db.relationship('Restaurant', backref='photos')
 
+    __table_args__ = (db.Index('ix_photos_rest_id', 'rest_id'),)
+
     def __repr__(self):
         """Provide helpful representation of photo."""
 
-        return "<id={} rest_id={}>".format(self.photo_id, self.rest_id)
+        return "<id={} rest_id={} source={}>".format(self.photo_id, self.rest_id, self.source)
+
+
+class Job(db.Model):
+    """Background work queued by the web app and run by the jobs.py worker."""
+
+    __tablename__ = 'jobs'
+
+    job_id = db.Column(db.Integer, autoincrement=True, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    rest_id = db.Column(db.Integer,
+                        db.ForeignKey('restaurants.rest_id'),
+                        nullable=False)
+    status = db.Column(db.String(64), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+    restaurant = db.relationship('Restaurant', backref='jobs')
+
+    # only one queued or running job of each kind per restaurant
+    __table_args__ = (db.Index('uq_jobs_active_kind_rest_id', 'kind', 'rest_id',
+                               unique=True,
+                               postgresql_where=db.text("status IN ('queued', 'running')"),
+                               sqlite_where=db.text("status IN ('queued', 'running')")),
+                      db.Index('ix_jobs_status_run_after', 'status', 'run_after'))
+
+    def to_dict(self):
+        """Return dict of job status."""
+
+        return {'job_id': self.job_id,
+                'kind': self.kind,
+                'status': self.status,
+                'attempts': self.attempts}
+
+    def __repr__(self):
+        """Provide helpful representation of job."""
+
+        return "<Job id={} kind={} rest_id={} status={}>".format(self.job_id,
+                                                                 self.kind,
+                                                                 self.rest_id,
+                                                                 self.status)
 
 
 ##############################################################################
@@ -353,17 +474,22 @@ def connect_to_db(app, db_uri='postgresql:///restaurants'):
 def example_data():
     """Create some sample data for testing."""
 
-    tal = User(email='talyaacovi@gmail.com', password='password', username='talyaac', city='SAN FRANCISCO', state='CA', zipcode='94103')
-    logan = User(email='loganbestwick@gmail.com', password='password', username='logan', city='SAN FRANCISCO', state='CA', zipcode='94103')
-    fred = User(email='fred@gmail.com', password='password', username='fred', city='SEATTLE', state='WA', zipcode='98105')
+    # cheapest bcrypt cost, so tests don't spend their time hashing
+    password = bcrypt.hashpw('password', bcrypt.gensalt(4))
+
+    tal = User(email='talyaacovi@gmail.com', password=password, username='talyaac', city='SAN FRANCISCO', state='CA', zipcode='94103')
+    logan = User(email='loganbestwick@gmail.com', password=password, username='logan', city='SAN FRANCISCO', state='CA', zipcode='94103')
+    fred = User(email='fred@gmail.com', password=password, username='fred', city='SEATTLE', state='WA', zipcode='98105')
 
-    sf = Zipcode(zipcode='94103', city='SAN FRANCISCO', state='CA', lat='37.77', lng='122.41')
-    seattle = Zipcode(zipcode='98105', city='SEATTLE', state='WA', lat='47.66', lng='122.29')
-    sf_2 = Zipcode(zipcode='94117', city='SAN FRANCISCO', state='CA', lat='37.76', lng='122.44')
+    sf = Zipcode(zipcode='94103', city='SAN FRANCISCO', state='CA', lat=37.77, lng=-122.41)
+    seattle = Zipcode(zipcode='98105', city='SEATTLE', state='WA', lat=47.66, lng=-122.29)
+    sf_2 = Zipcode(zipcode='94117', city='SAN FRANCISCO', state='CA', lat=37.76, lng=-122.44)
 
     favorites = ListCategory(category='favorites')
+    custom = ListCategory(category='custom')
+    user_count = SiteCounter(name='users', value=3)
 
-    db.session.add_all([tal, logan, fred, sf, seattle, sf_2, favorites])
+    db.session.add_all([tal, logan, fred, sf, seattle, sf_2, favorites, custom, user_count])
     db.session.commit()
 
 
@@ -0,0 +1,104 @@
+"""Check that the hot queries are planned with indexes, not sequential scans.
+
+Sequential scans are disabled while explaining, so Postgres only falls back
+to one when no index can serve the query. Run against a migrated database:
+
+    python query_plans.py
+"""
+
+import re
+from sqlalchemy.dialects import postgresql
+from sqlalchemy import func
+from model import *
+
+
+SEQ_SCAN = re.compile(r"Seq Scan on (\w+)")
+
+
+def get_hot_queries():
+    """Get dict of name to query for the queries run on every page view."""
+
+    return {
+        'locals in city': (User.query.filter(User.state == 'CA',
+                                             User.city == 'SAN FRANCISCO')),
+
+        'favorites count': (db.session.query(ListItem.item_id)
+                                      .join(List)
+                                      .join(User)
+                                      .filter(User.user_id == 1,
+                                              List.category_id == 1)),
+
+        'list membership': (ListItem.query.join(List)
+                                          .filter(List.user_id == 1,
+                                                  ListItem.rest_id == 1,
+                                                  List.list_id == 1)),
+
+        'restaurant by yelp id': (Restaurant.query.filter(Restaurant.yelp_id == 'la-ciccia')),
+
+        'top categories': (db.session.query(Restaurant.yelp_category,
+                                            Restaurant.yelp_alias)
+                                     .join(ListItem)
+                                     .join(List)
+                                     .join(User)
+                                     .filter(User.username == 'talyaac',
+                                             List.category_id == 1)
+                                     .group_by(Restaurant.yelp_category,
+                                               Restaurant.yelp_alias)
+                                     .order_by(db.desc(func.count(Restaurant.yelp_category)))
+                                     .limit(5)),
+
+        'city top 10': (db.session.query(Restaurant, CityRestaurantCount.count)
+                                  .join(CityRestaurantCount)
+                                  .filter(CityRestaurantCount.state == 'CA',
+                                          CityRestaurantCount.city == 'SAN FRANCISCO')
+                                  .order_by(db.desc(CityRestaurantCount.count), Restaurant.name)
+                                  .limit(10)),
+
+        'restaurant photos': (Photo.query.filter(Photo.rest_id == 1)),
+
+        'user profile': (Profile.query.filter(Profile.user_id == 1)),
+    }
+
+
+def explain(query):
+    """Get the Postgres plan for a query as a list of lines."""
+
+    sql = query.statement.compile(dialect=postgresql.dialect(),
+                                  compile_kwargs={'literal_binds': True})
+
+    return [row[0] for row in db.session.execute('EXPLAIN ' + str(sql))]
+
+
+def check_query_plans():
+    """Get dict of query name to tables it sequentially scans.
+
+    An empty dict means every hot query can be served by an index.
+    """
+
+    db.session.execute('SET LOCAL enable_seqscan = off')
+
+    seq_scans = {}
+    for name, query in sorted(get_hot_queries().items()):
+        tables = sorted(set(SEQ_SCAN.findall('\n'.join(explain(query)))))
+        if tables:
+            seq_scans[name] = tables
+
+    db.session.rollback()
+
+    return seq_scans
+
+
+if __name__ == "__main__":
+    from server import app
+
+    connect_to_db(app)
+
+    seq_scans = check_query_plans()
+
+    for name, tables in sorted(seq_scans.items()):
+        print "{}: sequential scan on {}".format(name, ', '.join(tables))
+
+    if seq_scans:
+        raise SystemExit(1)
+
+    print "All hot queries use indexes."
@@ -0,0 +1,180 @@
+"""Per-request SQL query counts for finding slow routes and N+1 queries.
+
+When the app runs in debug or testing mode, or with QUERY_STATS set in its
+config, every response gets X-Query-Count, X-Query-Time-Ms and
+X-Query-Repeats headers, and /_debug/queries reports totals per route. A
+route is flagged when one statement repeats many times in a request, or when
+its query count grows with the size of its responses.
+"""
+
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from flask import g, request, jsonify, abort, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# same statement shape this many times in one request looks like an N+1
+REPEAT_THRESHOLD = 5
+
+# requests per route kept for checking whether queries grow with results
+SAMPLE_SIZE = 100
+MIN_SAMPLES = 3
+GROWTH_CORRELATION = 0.8
+
+_routes = {}
+_lock = threading.Lock()
+
+
+def statement_shape(statement):
+    """Normalize SQL so the same query with different values matches."""
+
+    shape = re.sub(r"\s+", ' ', statement).strip()
+    shape = re.sub(r"IN \([^)]*\)", 'IN (...)', shape)
+    shape = re.sub(r"'[^']*'", '?', shape)
+    shape = re.sub(r"\b\d+\b", '?', shape)
+
+    return shape
+
+
+def is_enabled(app):
+    """Check if queries should be counted for this app."""
+
+    return app.debug or app.testing or app.config.get('QUERY_STATS', False)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    """Note when a query starts."""
+
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    """Add a finished query to the current request's counts."""
+
+    start = conn.info['query_start'].pop()
+
+    if not has_request_context():
+        return
+
+    stats = g.get('query_stats')
+    if stats is not None:
+        stats['count'] += 1
+        stats['time'] += time.time() - start
+        stats['shapes'][statement_shape(statement)] += 1
+
+
+def correlation(xs, ys):
+    """Get Pearson correlation of two lists, or 0 if either doesn't vary."""
+
+    n = float(len(xs))
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+
+    cov = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    var_y = sum((y - mean_y) ** 2 for y in ys)
+
+    if not var_x or not var_y:
+        return 0.0
+
+    return cov / (var_x * var_y) ** 0.5
+
+
+def record_request(endpoint, count, elapsed, size, repeated):
+    """Add a request's query counts to its route's totals."""
+
+    with _lock:
+        route = _routes.get(endpoint)
+
+        if route is None:
+            route = {'requests': 0,
+                     'queries': 0,
+                     'max_queries': 0,
+                     'time': 0.0,
+                     'repeated': {},
+                     'samples': deque(maxlen=SAMPLE_SIZE)}
+            _routes[endpoint] = route
+
+        route['requests'] += 1
+        route['queries'] += count
+        route['max_queries'] = max(route['max_queries'], count)
+        route['time'] += elapsed
+
+        for shape, times in repeated.items():
+            route['repeated'][shape] = max(route['repeated'].get(shape, 0), times)
+
+        if size is not None:
+            route['samples'].append((size, count))
+
+
+def get_report():
+    """Get dict of query totals and N+1 flags per route."""
+
+    report = {}
+
+    with _lock:
+        for endpoint, route in _routes.items():
+            sizes = [size for size, count in route['samples']]
+            counts = [count for size, count in route['samples']]
+
+            grows = (len(counts) >= MIN_SAMPLES and
+                     correlation(sizes, counts) >= GROWTH_CORRELATION)
+
+            report[endpoint] = {'requests': route['requests'],
+                                'avg_queries': route['queries'] / float(route['requests']),
+                                'max_queries': route['max_queries'],
+                                'avg_time_ms': 1000 * route['time'] / route['requests'],
+                                'repeated_statements': dict(route['repeated']),
+                                'queries_grow_with_results': grows,
+                                'flagged': grows or bool(route['repeated'])}
+
+    return report
+
+
+def reset_stats():
+    """Forget all recorded requests."""
+
+    with _lock:
+        _routes.clear()
+
+
+def init_query_stats(app):
+    """Count queries for each request to app and add the report route."""
+
+    @app.before_request
+    def start_query_stats():
+        if is_enabled(app):
+            g.query_stats = {'count': 0, 'time': 0.0, 'shapes': defaultdict(int)}
+
+    @app.after_request
+    def add_query_stats(response):
+        stats = g.get('query_stats')
+
+        if stats is None or request.endpoint == 'show_query_stats':
+            return response
+
+        repeated = dict((shape, times) for shape, times in stats['shapes'].items()
+                        if times >= REPEAT_THRESHOLD)
+
+        response.headers['X-Query-Count'] = str(stats['count'])
+        response.headers['X-Query-Time-Ms'] = '{:.1f}'.format(1000 * stats['time'])
+        response.headers['X-Query-Repeats'] = str(max(stats['shapes'].values() or [0]))
+
+        record_request(request.endpoint, stats['count'], stats['time'],
+                       response.calculate_content_length(), repeated)
+
+        return response
+
+    @app.route('/_debug/queries')
+    def show_query_stats():
+        """Show query counts per route and routes that look like N+1s."""
+
+        if not is_enabled(app):
+            abort(404)
+
+        return jsonify(get_report())
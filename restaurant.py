@@ -4,7 +4,20 @@ from model import *
 from yelp_api import business
 from ig import *
 from thread import *
+from flask import render_template
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from similarity import add_favorite, remove_favorite
+from leaderboard import increment_city_count, decrement_city_counts, get_city_rank
+from geo import bounding_box, haversine
+from user_context import invalidate_user
+from counters import change_favorites_count
+from collections import Counter
+from search_index import index_restaurant
+
+
+# restaurants can't be added to lists that already have this many
+MAX_LIST_ITEMS = 20
 
 
 def add_new_restaurant(yelp_id):
@@ -36,7 +49,15 @@ def add_new_restaurant(yelp_id):
                                 address=address, city=city, state=state)
 
         db.session.add(restaurant)
-        db.session.commit()
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another request added the same restaurant first
+            db.session.rollback()
+            restaurant = Restaurant.query.filter(Restaurant.yelp_id == yelp_id).first()
+        else:
+            index_restaurant(restaurant.rest_id, restaurant.to_dict())
 
     return restaurant.rest_id
 
@@ -51,10 +72,22 @@ def add_list_item(rest_id, lst_id, user_id):
                           .all()):
 
         lst_item = ListItem(list_id=lst_id, rest_id=rest_id)
+        lst = List.query.get(lst_id)
+        user = lst.user
 
         db.session.add(lst_item)
+        lst.item_count = List.item_count + 1
+
+        if lst.category_id == 1:
+            increment_city_count(user.state, user.city, rest_id)
+            change_favorites_count(user.user_id, 1)
+
         db.session.commit()
 
+        if lst.category_id == 1:
+            add_favorite(user.state, user.city, user.user_id, rest_id)
+            invalidate_user(user.user_id)
+
         return lst_item
 
     else:
@@ -64,17 +97,104 @@ def add_list_item(rest_id, lst_id, user_id):
 def del_list_item(item_id):
     """Remove list item from DB."""
 
-    lst_item = ListItem.query.get(item_id)
-    rest_id = lst_item.rest_id
+    rest_id = db.session.query(ListItem.rest_id).filter(ListItem.item_id == item_id).scalar()
 
-    db.session.delete(lst_item)
-    db.session.commit()
+    delete_list_items([item_id])
 
     restaurant = Restaurant.query.get(rest_id)
 
     return restaurant
 
 
+def remove_favorite_counts(favorites):
+    """Take deleted favorites out of the city and per-user counts, uncommitted."""
+
+    decrement_city_counts(Counter((state, city, rest_id)
+                                  for state, city, user_id, rest_id in favorites))
+
+    per_user = Counter(user_id for state, city, user_id, rest_id in favorites)
+
+    for user_id, count in per_user.items():
+        change_favorites_count(user_id, -count)
+
+
+def get_favorite_items(criterion):
+    """Get (state, city, user_id, rest_id) of favorites list items matching."""
+
+    return (db.session.query(User.state, User.city, User.user_id, ListItem.rest_id)
+                      .select_from(User)
+                      .join(List)
+                      .join(ListItem)
+                      .filter(criterion, List.category_id == 1)
+                      .all())
+
+
+def delete_list_items(item_ids):
+    """Delete many list items in one transaction, returning how many."""
+
+    if not item_ids:
+        return 0
+
+    favorites = get_favorite_items(ListItem.item_id.in_(item_ids))
+    remove_favorite_counts(favorites)
+
+    list_counts = (db.session.query(ListItem.list_id, func.count(ListItem.item_id))
+                             .filter(ListItem.item_id.in_(item_ids))
+                             .group_by(ListItem.list_id)
+                             .all())
+
+    for list_id, count in list_counts:
+        (List.query.filter(List.list_id == list_id)
+                   .update({List.item_count: List.item_count - count},
+                           synchronize_session=False))
+
+    deleted = (ListItem.query.filter(ListItem.item_id.in_(item_ids))
+                             .delete(synchronize_session=False))
+    db.session.commit()
+
+    for state, city, user_id, rest_id in favorites:
+        remove_favorite(state, city, user_id, rest_id)
+
+    for user_id in set(user_id for state, city, user_id, rest_id in favorites):
+        invalidate_user(user_id)
+
+    return deleted
+
+
+def delete_lists(list_ids):
+    """Delete many lists and their items in one transaction, returning how many.
+
+    List items are removed by the ON DELETE CASCADE on list_items.list_id.
+    """
+
+    if not list_ids:
+        return 0
+
+    favorites = get_favorite_items(List.list_id.in_(list_ids))
+    remove_favorite_counts(favorites)
+
+    deleted = (List.query.filter(List.list_id.in_(list_ids))
+                         .delete(synchronize_session=False))
+    db.session.commit()
+
+    for state, city, user_id, rest_id in favorites:
+        remove_favorite(state, city, user_id, rest_id)
+
+    for user_id in set(user_id for state, city, user_id, rest_id in favorites):
+        invalidate_user(user_id)
+
+    return deleted
+
+
+def delete_user_lists(user_id):
+    """Delete every list a user has, e.g. when closing their account."""
+
+    list_ids = [list_id for (list_id,) in
+                db.session.query(List.list_id).filter(List.user_id == user_id)]
+
+    return delete_lists(list_ids)
+
+
 def get_list(username, listname):
     """Get list object from DB"""
 
@@ -97,16 +217,9 @@ def get_list_items(lst_id):
 def delete_list(list_id):
     """Delete list from database."""
 
-    lst = List.query.filter_by(list_id=list_id).first()
-    list_items = lst.list_items
-    lst_name = lst.name
-
-    for item in list_items:
-        db.session.delete(item)
-        db.session.commit()
+    lst_name = db.session.query(List.name).filter(List.list_id == list_id).scalar()
 
-    db.session.delete(lst)
-    db.session.commit()
+    delete_lists([list_id])
 
     return lst_name + ' has been deleted.'
 
@@ -153,13 +266,32 @@ def add_fav_list(user_id, name, status, category_id):
 
 
 def get_list_items_react(lst_id):
-    """Get list items for React version of page."""
-
-    lst_items = ListItem.query.filter(ListItem.list_id == lst_id).all()
+    """Get list items for React version of page.
+
+    Items and their restaurants are read in one query straight into dicts.
+    """
+
+    rows = (db.session.query(ListItem.item_id,
+                             Restaurant.name,
+                             Restaurant.yelp_id,
+                             Restaurant.yelp_category,
+                             Restaurant.yelp_url,
+                             Restaurant.yelp_photo,
+                             Restaurant.ig_loc_id)
+                      .join(Restaurant)
+                      .filter(ListItem.list_id == lst_id)
+                      .order_by(ListItem.item_id)
+                      .all())
 
     restList = []
-    for item in lst_items:
-        restList.append(item.to_dict())
+    for item_id, name, yelp_id, yelp_category, yelp_url, yelp_photo, ig_loc_id in rows:
+        restList.append({'rest_name': name,
+                         'yelp_id': yelp_id,
+                         'item_id': item_id,
+                         'yelp_category': yelp_category,
+                         'yelp_url': yelp_url,
+                         'image': yelp_photo,
+                         'ig_loc_id': ig_loc_id})
 
     restDict = {'restaurants': restList}
 
@@ -167,45 +299,77 @@ def get_list_items_react(lst_id):
 
 
 def get_list_items_email(lst_items):
-    """Get restaurants for email."""
+    """Get restaurants for email, in the order of the Yelp ids given."""
+
+    restaurants = {}
+    if lst_items:
+        restaurants = {rest.yelp_id: rest for rest in
+                       Restaurant.query.filter(Restaurant.yelp_id.in_(lst_items)).all()}
 
     restList = []
     for item in lst_items:
-        restaurant = Restaurant.query.filter(Restaurant.yelp_id == item).first()
-        restList.append(restaurant.to_dict())
+        if item in restaurants:
+            restList.append(restaurants[item].to_dict())
 
     restDict = {'restaurants': restList}
 
     return restDict
 
 
+def get_list_email_body(lst_items):
+    """Get numbered HTML list of restaurant links for a list email."""
+
+    restaurants = get_list_items_email(lst_items)['restaurants']
+
+    return render_template('list_email.html', restaurants=restaurants)
+
+
 def get_ranking(yelp_id, city, state):
     """Get ranking of restaurant in that city."""
 
-    restaurants = (db.session.query(Restaurant.yelp_id)
-                             .join(ListItem)
-                             .join(List)
-                             .filter(Restaurant.state == state,
-                                     Restaurant.city == city,
-                                     List.category_id == 1)
-                             .group_by(Restaurant.yelp_id, Restaurant.name)
-                             .order_by(db.desc(func.count(ListItem.rest_id)), Restaurant.name)
-                             .all())
-    restaurants = [item[0] for item in restaurants]
-    if yelp_id in restaurants:
-        return restaurants.index(yelp_id) + 1
+    return get_city_rank(yelp_id, state.upper(), city.upper())
 
-    return None
 
 def check_lists(rest_id, user_id):
-    """Get lists for a user that don't already contain specific restaurant."""
+    """Get (name, list_id) of a user's lists that a restaurant can be added to.
+
+    Leaves out full lists and lists that already contain the restaurant.
+    """
+
+    in_list = (db.session.query(ListItem.item_id)
+                         .filter(ListItem.list_id == List.list_id,
+                                 ListItem.rest_id == rest_id)
+                         .exists())
+
+    return (db.session.query(List.name, List.list_id)
+                      .filter(List.user_id == user_id,
+                              List.item_count < MAX_LIST_ITEMS,
+                              ~in_list)
+                      .order_by(List.list_id)
+                      .all())
+
+
+def get_nearby_restaurants(lat, lng, radius, limit=10):
+    """Get most favorited restaurants within radius meters of a point.
+
+    Returns list of (Restaurant, favorites count, distance) tuples.
+    """
+
+    min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius)
+
+    rows = (db.session.query(Restaurant, func.sum(CityRestaurantCount.count))
+                      .join(CityRestaurantCount)
+                      .filter(Restaurant.lat.between(min_lat, max_lat),
+                              Restaurant.lng.between(min_lng, max_lng))
+                      .group_by(Restaurant.rest_id)
+                      .all())
 
-    user_lists = User.query.filter(User.user_id == user_id).first().lists
+    nearby = []
+    for restaurant, favorites in rows:
+        distance = haversine(lat, lng, restaurant.lat, restaurant.lng)
+        if distance <= radius:
+            nearby.append((restaurant, int(favorites), distance))
 
-    lsts_to_add = []
-    for lst in user_lists:
-        rest_ids = [x.rest_id for x in lst.list_items]
-        if rest_id not in rest_ids and len(rest_ids) < 20:
-            lsts_to_add.append((lst.name, lst.list_id))
+    nearby.sort(key=lambda item: (-item[1], item[2]))
 
-    return lsts_to_add
\ No newline at end of file
+    return nearby[:limit]
@@ -0,0 +1,185 @@
+"""In-memory search of a city's restaurants by name and category.
+
+Each city's restaurants are loaded once per process into a trigram index of
+padded words, so any typed prefix of a word narrows the candidates without
+scanning. Restaurants added later are indexed as they are saved.
+"""
+
+import re
+import threading
+from unicodedata import normalize
+
+from sqlalchemy import func
+from model import db, Restaurant
+
+
+SEARCH_LIMIT = 10
+
+
+def search_words(text):
+    """Get lowercase ascii words of a name or search term."""
+
+    if not text:
+        return []
+
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'ignore')
+
+    text = normalize('NFKD', text).encode('ascii', 'ignore').lower()
+
+    return re.findall(r"[a-z0-9]+", text.replace("'", ''))
+
+
+def prefix_trigrams(word):
+    """Get trigrams of a word padded at the front, so prefixes share them."""
+
+    padded = '  ' + word
+
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class CityRestaurants(object):
+    """Restaurants of one city indexed by the trigrams of their words.
+
+    A term matches a restaurant when every word of the term is the start of
+    a word in its name or category.
+    """
+
+    def __init__(self):
+        self.restaurants = {}
+        self.words = {}
+        self.trigrams = {}
+
+    def add(self, rest_id, yelp_id, name, category, address):
+        """Index a restaurant, replacing it if already indexed."""
+
+        self.remove(rest_id)
+
+        words = set(search_words(name)) | set(search_words(category))
+
+        self.restaurants[rest_id] = {'name': name, 'id': yelp_id, 'location': address}
+        self.words[rest_id] = words
+
+        for word in words:
+            for trigram in prefix_trigrams(word):
+                self.trigrams.setdefault(trigram, set()).add(rest_id)
+
+    def remove(self, rest_id):
+        """Drop a restaurant from the index."""
+
+        for word in self.words.pop(rest_id, ()):
+            for trigram in prefix_trigrams(word):
+                self.trigrams[trigram].discard(rest_id)
+
+        self.restaurants.pop(rest_id, None)
+
+    def search(self, term, limit=SEARCH_LIMIT):
+        """Get result dicts for restaurants matching a term, best first.
+
+        Names starting with the term come before other matches.
+        """
+
+        term_words = search_words(term)
+
+        if not term_words:
+            return []
+
+        candidates = None
+        for word in term_words:
+            for trigram in prefix_trigrams(word):
+                matches = self.trigrams.get(trigram, set())
+                candidates = matches.copy() if candidates is None else candidates & matches
+
+                if not candidates:
+                    return []
+
+        # trigrams can come from different words, so check each prefix
+        results = [rest_id for rest_id in candidates
+                   if all(any(word.startswith(term_word) for word in self.words[rest_id])
+                          for term_word in term_words)]
+
+        def rank(rest_id):
+            name = self.restaurants[rest_id]['name']
+            name_words = search_words(name)
+            starts_name = bool(name_words) and name_words[0].startswith(term_words[0])
+            return (not starts_name, name.lower())
+
+        return [dict(self.restaurants[rest_id]) for rest_id in sorted(results, key=rank)[:limit]]
+
+
+_index = {}
+_lock = threading.Lock()
+
+
+def city_key(state, city):
+    """Get index key for a city, ignoring case."""
+
+    return (state.upper(), city.upper())
+
+
+def load_city_restaurants(state, city):
+    """Build the search index for a city with a single query."""
+
+    state, city = city_key(state, city)
+
+    rows = (db.session.query(Restaurant.rest_id, Restaurant.yelp_id, Restaurant.name,
+                             Restaurant.yelp_category, Restaurant.address)
+                      .filter(func.upper(Restaurant.state) == state,
+                              func.upper(Restaurant.city) == city)
+                      .all())
+
+    city_restaurants = CityRestaurants()
+    for row in rows:
+        city_restaurants.add(*row)
+
+    return city_restaurants
+
+
+def get_city_restaurants(state, city):
+    """Get the search index for a city, loading it on first use.
+
+    The city is loaded while holding the lock, so a restaurant saved during
+    the load waits in index_restaurant and is added afterwards.
+    """
+
+    key = city_key(state, city)
+
+    with _lock:
+        city_restaurants = _index.get(key)
+
+        if city_restaurants is None:
+            city_restaurants = _index[key] = load_city_restaurants(state, city)
+
+    return city_restaurants
+
+
+def index_restaurant(rest_id, rest_dict):
+    """Add a saved restaurant, given as Restaurant.to_dict(), to its city's index.
+
+    Does nothing if that city hasn't been loaded yet.
+    """
+
+    if not (rest_dict['state'] and rest_dict['city']):
+        return
+
+    with _lock:
+        city_restaurants = _index.get(city_key(rest_dict['state'], rest_dict['city']))
+        if city_restaurants is not None:
+            city_restaurants.add(rest_id, rest_dict['yelp_id'], rest_dict['rest_name'],
+                                 rest_dict['yelp_category'], rest_dict['address'])
+
+
+def reset_search_index():
+    """Forget all indexed cities so they are reloaded on next use."""
+
+    with _lock:
+        _index.clear()
+
+
+def search_restaurants(term, state, city, limit=SEARCH_LIMIT):
+    """Get result dicts for a city's restaurants matching a search term."""
+
+    city_restaurants = get_city_restaurants(state, city)
+
+    with _lock:
+        return city_restaurants.search(term, limit)
@@ -1,39 +1,118 @@
-"""Utility file to seed ratings database from MovieLens data in seed_data/"""
+"""Utility file to seed restaurants database with zipcodes and list categories.
 
+Loaders are idempotent, so they can be rerun to refresh an existing database.
+"""
+
+import csv
+import time
+from cStringIO import StringIO
+from sqlalchemy import bindparam
 from model import *
 from server import app
+from locations import ZIPCODES_CSV, read_locations_csv
+
+
+# rows per executemany batch when COPY isn't available
+BATCH_SIZE = 5000
+
+ZIPCODE_COLUMNS = ['zipcode', 'city', 'state', 'lat', 'lng']
+
+
+def copy_zipcodes(locations):
+    """Upsert locations with COPY into a staging table, for Postgres."""
+
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerows(locations)
+    buf.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute("""CREATE TEMPORARY TABLE zipcodes_staging
+                        (LIKE zipcodes INCLUDING DEFAULTS) ON COMMIT DROP""")
+    cursor.copy_expert("COPY zipcodes_staging ({}) FROM STDIN WITH CSV"
+                       .format(', '.join(ZIPCODE_COLUMNS)), buf)
+    cursor.execute("""INSERT INTO zipcodes ({0})
+                        SELECT {0} FROM zipcodes_staging
+                      ON CONFLICT (zipcode) DO UPDATE
+                        SET city = EXCLUDED.city,
+                            state = EXCLUDED.state,
+                            lat = EXCLUDED.lat,
+                            lng = EXCLUDED.lng""".format(', '.join(ZIPCODE_COLUMNS)))
+
+
+def batch_zipcodes(locations):
+    """Upsert locations with batched executemany inserts and updates."""
+
+    table = Zipcode.__table__
+    existing = set(zipcode for (zipcode,) in db.session.query(Zipcode.zipcode))
 
+    rows = [location._asdict() for location in locations]
+    new_rows = [row for row in rows if row['zipcode'] not in existing]
+    # bind names can't match the updated column names
+    old_rows = [dict(('b_' + key, value) for key, value in row.items())
+                for row in rows if row['zipcode'] in existing]
 
-def load_zips():
-    """Load users from u.user into database."""
+    update = (table.update()
+                   .where(table.c.zipcode == bindparam('b_zipcode'))
+                   .values(city=bindparam('b_city'), state=bindparam('b_state'),
+                           lat=bindparam('b_lat'), lng=bindparam('b_lng')))
+
+    for start in range(0, len(new_rows), BATCH_SIZE):
+        db.session.execute(table.insert(), new_rows[start:start + BATCH_SIZE])
+
+    for start in range(0, len(old_rows), BATCH_SIZE):
+        db.session.execute(update, old_rows[start:start + BATCH_SIZE])
+
+
+def load_zips(path=ZIPCODES_CSV):
+    """Load zipcodes from the zipcodes CSV into the database.
+
+    Invalid rows are skipped, and zipcodes already in the table are updated.
+    Returns the number of zipcodes loaded. Running web servers keep their
+    zipcode lookups until restarted.
+    """
 
     print "Zipcodes"
 
-    with open('zipcodes.csv') as f:
-        for row in f:
-            row = row.rstrip()
-            zipcode, city, state, lat, lng = row.split(",")
+    start = time.time()
 
-            zipcode = Zipcode(zipcode=zipcode,
-                              city=city,
-                              state=state,
-                              lat=lat,
-                              lng=lng)
+    # later rows win, so each zipcode is upserted once
+    locations = {}
+    skipped = 0
 
-            db.session.add(zipcode)
+    for location in read_locations_csv(path):
+        if location is None:
+            skipped += 1
+        else:
+            locations[location.zipcode] = location
+
+    locations = sorted(locations.values())
+
+    if db.engine.name == 'postgresql':
+        copy_zipcodes(locations)
+    else:
+        batch_zipcodes(locations)
 
     db.session.commit()
 
+    elapsed = time.time() - start
+    print "Loaded {} zipcodes in {:.2f}s ({:.0f} rows/s), skipped {} invalid rows".format(
+        len(locations), elapsed, len(locations) / max(elapsed, 0.001), skipped)
+
+    return len(locations)
+
 
 def load_list_categories():
     """Load list categories into DB."""
 
     print "List Categories"
 
-    favorites = ListCategory(category='favorites')
-    custom = ListCategory(category='custom')
+    existing = set(category for (category,) in db.session.query(ListCategory.category))
+
+    for category in ['favorites', 'custom']:
+        if category not in existing:
+            db.session.add(ListCategory(category=category))
 
-    db.session.add_all([favorites, custom])
     db.session.commit()
 
 if __name__ == "__main__":
@@ -1,81 +1,214 @@
+"""SendGrid email helpers.
+
+Emails are queued and sent by a background thread so requests don't wait on
+SendGrid. Messages that share everything but their recipients are batched
+into one API call with several personalizations. The queue is in memory, so
+messages still queued when the process exits are lost.
+"""
+
+import Queue
+import logging
 import requests
 import os
 import json
+import threading
+import time
+from requests.adapters import HTTPAdapter
 
 
-def send_user_list_email(receiver, sender, body, city, state, username, from_name, list_type):
-    # API Config
-    api_url = 'https://api.sendgrid.com/v3/mail/send'
+API_URL = 'https://api.sendgrid.com/v3/mail/send'
 
-    # TO
-    to_email = receiver
+USER_LIST_TEMPLATE_ID = 'bf87a489-971d-466c-9d75-72f0bf9d8d45'
+CITY_LIST_TEMPLATE_ID = '0aaf36d5-b4fc-440e-8d86-504768797c7e'
 
-    #FROM
-    from_name = from_name
-    fom_email = sender
-    from_subject = 'Restaurant List'
-    body = body
+# SendGrid accepts up to 1000 personalizations per request
+MAX_PERSONALIZATIONS = 1000
 
-    headers = {
-        'content-type': 'application/json',
-        'Authorization': 'Bearer ' + os.environ.get('SENDGRID_API_KEY')
-    }
-    payload = {
+MAX_RETRIES = 3
+BACKOFF = 1
 
-        "personalizations": [
-            {
-                "to": [
-                    {
-                        "email": to_email
-                    }
-                ],
-                "substitutions": {
-                    "-name-": username,
-                    "-city-": city + ', ' + state,
-                    "-from-": from_name,
-                    "-type-": list_type
-                },
-            }],
+# seconds to wait for more messages to batch with the first one
+BATCH_WAIT = 0.5
 
-        "from": {
-            "email": fom_email,
-            "name": from_name
-        },
+TIMEOUT = (3.05, 10)
 
-        "subject": from_subject,
+logger = logging.getLogger(__name__)
 
-        "content": [{
-            "type": "text/html", "value": body
-        }],
 
-        "template_id": "bf87a489-971d-466c-9d75-72f0bf9d8d45"
+class SendGridTransport(object):
+    """Posts messages to the SendGrid API over a pooled keep-alive session."""
+
+    def __init__(self, api_url=API_URL, timeout=TIMEOUT):
+        self.api_url = api_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+    def send(self, payload):
+        """Send a message payload and return the HTTP status code."""
+
+        headers = {
+            'content-type': 'application/json',
+            'Authorization': 'Bearer ' + os.environ.get('SENDGRID_API_KEY')
         }
 
-    r = requests.post(api_url, data=json.dumps(payload), headers=headers)
-    if (r):
-        return True
-    else:
+        r = self.session.post(self.api_url, data=json.dumps(payload),
+                              headers=headers, timeout=self.timeout)
+
+        return r.status_code
+
+
+class LocalSinkTransport(object):
+    """Keeps message payloads in memory instead of sending them, for tests."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, payload):
+        """Record a message payload as sent."""
+
+        self.sent.append(payload)
+
+        return 202
+
+
+def batch_key(payload):
+    """Get key shared by messages that can go in the same API call."""
+
+    return json.dumps(dict((key, value) for key, value in payload.items()
+                           if key != 'personalizations'), sort_keys=True)
+
+
+def batch_messages(payloads):
+    """Merge payloads that only differ in personalizations."""
+
+    batches = {}
+    order = []
+
+    for payload in payloads:
+        key = batch_key(payload)
+        batch = batches.get(key)
+
+        if batch is None or len(batch['personalizations']) >= MAX_PERSONALIZATIONS:
+            batch = dict(payload, personalizations=[])
+            batches[key] = batch
+            order.append(batch)
+
+        batch['personalizations'].extend(payload['personalizations'])
+
+    return order
+
+
+class EmailDispatcher(object):
+    """Queue of outgoing emails sent in batches by a background thread."""
+
+    def __init__(self, transport, max_retries=MAX_RETRIES, backoff=BACKOFF,
+                 batch_wait=BATCH_WAIT, autostart=True):
+        self.transport = transport
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.batch_wait = batch_wait
+        self.autostart = autostart
+        self.queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, payload):
+        """Queue a message payload to be sent."""
+
+        self.queue.put(payload)
+
+        if self.autostart:
+            self.start()
+
+    def start(self):
+        """Start the sending thread if it isn't running."""
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def run(self):
+        """Send queued messages forever."""
+
+        while True:
+            payloads = [self.queue.get()]
+            time.sleep(self.batch_wait)
+
+            try:
+                self.send_batches(payloads + self.drain())
+            except Exception:
+                # keep the thread alive for the messages queued after these
+                logger.exception('Could not send email batches')
+
+    def drain(self):
+        """Get every message queued right now."""
+
+        payloads = []
+        while True:
+            try:
+                payloads.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return payloads
+
+    def send_pending(self):
+        """Send every queued message from the calling thread."""
+
+        self.send_batches(self.drain())
+
+    def send_batches(self, payloads):
+        """Send payloads batched together, then mark them done."""
+
+        try:
+            for batch in batch_messages(payloads):
+                try:
+                    self.send_with_retries(batch)
+                except Exception:
+                    logger.exception('Could not send email to %d recipients',
+                                     len(batch['personalizations']))
+        finally:
+            for _ in payloads:
+                self.queue.task_done()
+
+    def send_with_retries(self, payload):
+        """Send a payload, retrying rate limits and server errors."""
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                status = self.transport.send(payload)
+            except (requests.ConnectionError, requests.Timeout):
+                logger.warning('SendGrid request failed')
+                status = None
+
+            if status is not None and status < 300:
+                return True
+
+            if status is not None and status != 429 and status < 500:
+                break
+
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * (2 ** attempt))
+
+        logger.error('Could not send email to %d recipients, last status %s',
+                     len(payload['personalizations']), status)
+
         return False
 
+    def wait_until_sent(self):
+        """Block until every queued message has been handled."""
 
-def send_city_list_email(receiver, sender, body, city_state, from_name):
-    # API Config
-    api_url = 'https://api.sendgrid.com/v3/mail/send'
+        self.queue.join()
 
-    # TO
-    to_email = receiver
 
-    #FROM
-    from_name = from_name
-    fom_email = sender
-    from_subject = 'Top Restaurants In ' + city_state
-    body = body
+dispatcher = EmailDispatcher(SendGridTransport())
 
-    headers = {
-        'content-type': 'application/json',
-        'Authorization': 'Bearer ' + os.environ.get('SENDGRID_API_KEY')
-    }
-    payload = {
+
+def build_message(to_email, from_email, from_name, subject, body, substitutions, template_id):
+    """Create SendGrid payload for a list email."""
+
+    return {
 
         "personalizations": [
             {
@@ -84,28 +217,51 @@ def send_city_list_email(receiver, sender, body, city_state, from_name):
                         "email": to_email
                     }
                 ],
-                "substitutions": {
-                    "-city-": city_state,
-                    "-from-": from_name
-                },
+                "substitutions": substitutions,
             }],
 
         "from": {
-            "email": fom_email,
+            "email": from_email,
             "name": from_name
         },
 
-        "subject": from_subject,
+        "subject": subject,
 
         "content": [{
             "type": "text/html", "value": body
         }],
 
-        "template_id": "0aaf36d5-b4fc-440e-8d86-504768797c7e"
+        "template_id": template_id
         }
 
-    r = requests.post(api_url, data=json.dumps(payload), headers=headers)
-    if (r):
-        return True
-    else:
-        return False
+
+def send_user_list_email(receiver, sender, body, city, state, username, from_name, list_type):
+    """Queue email with a user's list."""
+
+    substitutions = {
+        "-name-": username,
+        "-city-": city + ', ' + state,
+        "-from-": from_name,
+        "-type-": list_type
+    }
+
+    dispatcher.enqueue(build_message(receiver, sender, from_name,
+                                     'Restaurant List', body, substitutions,
+                                     USER_LIST_TEMPLATE_ID))
+
+    return True
+
+
+def send_city_list_email(receiver, sender, body, city_state, from_name):
+    """Queue email with the top restaurants in a city."""
+
+    substitutions = {
+        "-city-": city_state,
+        "-from-": from_name
+    }
+
+    dispatcher.enqueue(build_message(receiver, sender, from_name,
+                                     'Top Restaurants In ' + city_state, body,
+                                     substitutions, CITY_LIST_TEMPLATE_ID))
+
+    return True
@@ -2,7 +2,7 @@
 
 from jinja2 import StrictUndefined
 
-from flask import Flask, render_template, request, flash, redirect, session, jsonify, url_for
+from flask import Flask, render_template, request, flash, redirect, session, jsonify, url_for, abort
 from flask_debugtoolbar import DebugToolbarExtension
 from werkzeug import secure_filename
 from model import *
@@ -13,12 +13,25 @@ from cities import *
 from discover import *
 from sendgrid import *
 from ig import *
+from enrich import get_hot_and_new
+from jobs import enqueue_job, get_latest_job
+from auth import authenticate
+from user_context import get_user_record, get_current_user, invalidate_user, user_cache
+from counters import get_counter, USERS
+from gallery import get_gallery
+from search_index import search_restaurants
 import fbg as fb
 import json
+import os
 from random import sample
+from functools import wraps
+from cache import TTLCache
+from query_stats import init_query_stats
 
 
 UPLOAD_FOLDER = 'static/uploads'
+MAX_NEARBY_RADIUS = 50000
+MAX_NEARBY_LIMIT = 50
 ALLOWED_EXTENSIONS = set(['txt', 'pdf', 'png', 'jpg', 'jpeg'])
 
 app = Flask(__name__)
@@ -29,8 +42,35 @@ app.secret_key = "ABC"
 app.jinja_env.undefined = StrictUndefined
 app.jinja_env.auto_reload = True
 
+# query counts per request, in debug/testing or with QUERY_STATS set
+init_query_stats(app)
+
+PAGE_CACHE_TTL = 300
+
+page_cache = TTLCache(max_size=16, ttl=PAGE_CACHE_TTL)
+
+
+def cache_public_page(view):
+    """Serve a page from cache to logged-out visitors with no flash messages."""
+
+    @wraps(view)
+    def cached_view(*args, **kwargs):
+        if 'user_id' in session or '_flashes' in session:
+            return view(*args, **kwargs)
+
+        page = page_cache.get(request.path)
+
+        if page is None:
+            page = view(*args, **kwargs)
+            page_cache.set(request.path, page)
+
+        return page
+
+    return cached_view
+
 
 @app.route('/')
+@cache_public_page
 def index():
     """Display homepage with all locations for which locals have made lists."""
 
@@ -42,6 +82,7 @@ def index():
 
 
 @app.route('/search')
+@cache_public_page
 def city_search():
     """Display homepage with all locations for which locals have made lists."""
 
@@ -55,12 +96,13 @@ def login_user():
     """Log user in to their account."""
 
     user_email = request.form.get('email')
-    email = check_email(user_email)
     user_password = request.form.get('password')
 
-    if email:
-        if check_password(email, user_password):
-            user = User.query.filter_by(email=email).first()
+    # fetches the user once and rehashes the password if the cost changed
+    user, is_valid = authenticate(user_email, user_password)
+
+    if user:
+        if is_valid:
             set_session_info(user)
             is_active = check_active(user.username)
             return jsonify({'msg': 'Success',
@@ -98,6 +140,11 @@ def signup_user():
     zipcode = request.form.get('zipcode')
     user = register_user(email, password, username, zipcode)
 
+    # the homepage map only lists cities that have locals
+    if is_new_city(user.state, user.city):
+        cities_cache.clear()
+        page_cache.clear()
+
     set_session_info(user)
 
     # create default 'Favorites' list
@@ -139,12 +186,12 @@ def get_user_lists():
 
     username = request.args.get('username')
 
-    user = get_user(username)
+    user = get_user_record(username=username)
 
     userLists = []
     userDict = {}
 
-    for lst in user.lists:
+    for lst in List.query.filter_by(user_id=user.user_id).order_by(List.list_id):
         userLists.append(lst.to_dict())
 
     userDict['userLists'] = userLists
@@ -216,16 +263,23 @@ def search_city():
 def display_city_page(state, city):
     """Display users and lists for a specific city."""
 
-    all_users = get_users_by_city(state, city)
-    restaurant_tuples = count_restaurants_by_city(state, city)
-    location = get_city_lat_lng(state, city)
+    page = max(request.args.get('page', 1, type=int), 1)
+    city_page = get_city_page(state, city, page)
 
     return render_template('city.html',
-                           all_users=all_users,
                            city=city,
                            state=state,
-                           restaurant_tuples=restaurant_tuples,
-                           location=location)
+                           **city_page)
+
+
+@app.route('/cities/<state>/<city>/locals.json')
+def get_city_locals(state, city):
+    """Get a page of a city's locals for loading more of the grid."""
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    locals_, has_next = get_locals_page(state, city, page)
+
+    return jsonify({'locals': locals_, 'page': page, 'hasNext': has_next})
 
 
 @app.route('/check-zipcode')
@@ -244,9 +298,10 @@ def do_zipcode_check():
 def do_discover():
     """Show a logged in user the local they are most similar to."""
 
-    restaurants = get_user_favorite_restaurants()
+    user = get_current_user()
 
-    if len(restaurants) >= 20 and User.query.count() > 1:
+    if user.favorites_count >= 20 and get_counter(USERS) > 1:
+        restaurants = get_user_favorite_restaurants()
         most_similar_user_dict = get_most_similar_user(restaurants)
         most_similar_user = most_similar_user_dict.get('name')
         rests_in_common_ids = most_similar_user_dict.get('rest_ids')
@@ -258,8 +313,6 @@ def do_discover():
         rests_in_common = get_common_rests(rests_in_common_ids)
         not_common = sample(get_common_rests(not_common_ids), 5)
 
-        user = User.query.filter_by(user_id=session.get('user_id')).first()
-
         top_catgs = get_user_top_catgs(user.username)
 
         catgs, aliases = zip(*top_catgs)
@@ -273,38 +326,10 @@ def do_discover():
 
         rests_user_has_added = get_restaurants_user_added(user.username)
 
-        hot_and_new = []
-
-        for item in results['businesses']:
-            if item['id'] not in rests_user_has_added:
-                rest_obj = check_if_rest_in_db(item['id'])
-                if rest_obj and rest_obj.ig_loc_id:
-                    ig_loc_id = rest_obj.ig_loc_id
-                elif rest_obj and not rest_obj.ig_loc_id:
-                    ig_loc_id = fb.request(item['name'], str(item['coordinates']['latitude']), str(item['coordinates']['longitude']))
-                    rest_obj.ig_loc_id = ig_loc_id
-                    db.session.commit()
-                else:
-                    ig_loc_id = fb.request(item['name'], str(item['coordinates']['latitude']), str(item['coordinates']['longitude']))
-                    rest_obj = Restaurant(name=item['name'],
-                                          lat=item['coordinates']['latitude'],
-                                          lng=item['coordinates']['longitude'],
-                                          yelp_id=item['id'],
-                                          yelp_url=item['url'].split('?')[0],
-                                          yelp_category=item['categories'][0]['title'],
-                                          yelp_alias=item['categories'][0]['alias'],
-                                          yelp_photo=item['image_url'],
-                                          address=item['location']['address1'],
-                                          city=item['location']['city'],
-                                          state=item['location']['state'],
-                                          ig_loc_id=ig_loc_id)
-
-                    db.session.add(rest_obj)
-                    db.session.commit()
-
-                new_dict = rest_obj.to_dict()
-
-                hot_and_new.append(new_dict)
+        new_businesses = [item for item in results['businesses']
+                          if item['id'] not in rests_user_has_added]
+
+        hot_and_new = get_hot_and_new(new_businesses)
 
         location = get_city_lat_lng(user.state, user.city)
 
@@ -313,7 +338,7 @@ def do_discover():
                                location=location,
                                hot_and_new=hot_and_new,
                                top_catgs=top_catgs,
-                               user_image=user.profiles[0].image_fn,
+                               user_image=user.image_fn,
                                similar_image=similar_image,
                                rests_in_common=rests_in_common,
                                most_similar_user=most_similar_user,
@@ -336,28 +361,56 @@ def get_list_items():
     return jsonify(lst_items)
 
 
+@app.route('/nearby.json')
+def get_nearby():
+    """Get most favorited restaurants near a lat/lng, radius in meters."""
+
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radius = request.args.get('radius', 1600, type=float)
+    limit = request.args.get('limit', 10, type=int)
+
+    if lat is None or lng is None or not -90 <= lat <= 90 or not -180 <= lng <= 180:
+        abort(400)
+
+    # NaN fails every comparison, so this also rejects radius=nan
+    if radius is None or not radius > 0 or limit is None or limit < 1:
+        abort(400)
+
+    radius = min(radius, MAX_NEARBY_RADIUS)
+    limit = min(limit, MAX_NEARBY_LIMIT)
+
+    restaurants = []
+    for restaurant, favorites, distance in get_nearby_restaurants(lat, lng, radius, limit):
+        rest_dict = restaurant.to_dict()
+        rest_dict['favorites'] = favorites
+        rest_dict['distance'] = int(round(distance))
+        restaurants.append(rest_dict)
+
+    return jsonify({'restaurants': restaurants})
+
+
 @app.route('/search-results.json')
 def do_restaurant_search():
     """Get search results using Yelp API."""
 
-    search_term = request.args.get('term')
+    search_term = request.args.get('term', '').strip().lower()
     username = request.args.get('username')
-    user_location = get_user_location(username)
-    city = user_location[0]
-    state = user_location[1]
-    search_location = city + ', ' + state
+    city, state = get_user_location(username)
 
-    results = search(search_term, search_location)
-    business_results = results['businesses']
+    # restaurants we already know about are found without calling Yelp
+    rests = search_restaurants(search_term, state, city)
 
-    results_dict = {'rests': []}
+    if not rests and search_term:
+        # Yelp responses are cached per term and location by the client
+        results = search(search_term, city + ', ' + state)
 
-    for item in business_results:
-        results_dict['rests'].append({'name': item['name'],
-                                      'id': item['id'],
-                                      'location': item['location']['display_address'][0]})
+        rests = [{'name': item['name'],
+                  'id': item['id'],
+                  'location': item['location']['display_address'][0]}
+                 for item in results.get('businesses', [])]
 
-    return jsonify(results_dict)
+    return jsonify({'rests': rests})
 
 
 @app.route('/add-restaurant.json', methods=['POST'])
@@ -434,18 +487,12 @@ def send_user_list():
 
     location = get_user_location(username)
 
-    lst_items_dict = get_list_items_email(lst_items)
-    restaurants = lst_items_dict['restaurants']
-
     from_email = 'talyaacovi@gmail.com'
-    email_body = ""
+    email_body = get_list_email_body(lst_items)
 
     city = location[0].title()
     state = location[1]
 
-    for index, item in enumerate(restaurants):
-        email_body = email_body + str(index + 1) + '. ' + '<a href="' + item['yelp_url'] + '">' + item['rest_name'] + '</a>' + "<br/>"
-
     if lst_name == 'favorites' or lst_name == 'Favorites':
         list_type = 'favorite restaurants'
     else:
@@ -465,14 +512,8 @@ def send_city_list():
     from_name = request.form.get('from')
     city_state = request.form.get('city_state')
 
-    lst_items_dict = get_list_items_email(lst_items)
-    restaurants = lst_items_dict['restaurants']
-
     from_email = 'talyaacovi@gmail.com'
-    email_body = ""
-
-    for index, item in enumerate(restaurants):
-        email_body = email_body + str(index + 1) + '. ' + '<a href="' + item['yelp_url'] + '">' + item['rest_name'] + '</a>' + "<br/>"
+    email_body = get_list_email_body(lst_items)
 
     send_city_list_email(to_email, from_email, email_body, city_state, from_name)
 
@@ -491,30 +532,34 @@ def do_check_active_user_id():
 
 @app.route('/instagram-photos')
 def get_instagram_data():
-    """Get location ID + photos with Facebook Graph API and IG scraper."""
+    """Queue Instagram location + photo lookup for a restaurant."""
 
-    # FLASK THREADING VERSION
     yelp_id = request.args.get('yelp_id')
 
     restaurant = Restaurant.query.filter_by(yelp_id=yelp_id).first()
 
-    if not restaurant.ig_loc_id:
-        loc_id = get_instagram_location(restaurant.rest_id,
-                                        restaurant.name,
-                                        restaurant.lat,
-                                        restaurant.lng,
-                                        restaurant.address,
-                                        restaurant.city)
+    if restaurant.ig_loc_id:
+        return jsonify({'status': 'done'})
+
+    job = enqueue_job('instagram', restaurant.rest_id)
+
+    return jsonify(job.to_dict())
+
+
+@app.route('/instagram-photos/status')
+def get_instagram_status():
+    """Get status of Instagram lookup and any photos found for a restaurant."""
 
-        if loc_id:
-            restaurant.ig_loc_id = loc_id
-            db.session.commit()
+    yelp_id = request.args.get('yelp_id')
 
-            successMsg = get_instagram_photos(restaurant.rest_id, loc_id)
+    restaurant = Restaurant.query.filter_by(yelp_id=yelp_id).first()
+    job = get_latest_job('instagram', restaurant.rest_id)
 
-            return successMsg
+    status = job.to_dict() if job else {'status': None}
+    status['ig_loc_id'] = restaurant.ig_loc_id
+    status['photos'] = [item.url for item in restaurant.photos]
 
-    return ''
+    return jsonify(status)
 
 
 @app.route('/restaurants/<yelp_id>')
@@ -522,19 +567,18 @@ def show_restaurant_details(yelp_id):
     """Details page for a restaurant with Instagram photos."""
 
     restaurant = Restaurant.query.filter_by(yelp_id=yelp_id).first()
-    photos = [item.url for item in restaurant.photos]
 
-    ranking = get_ranking(restaurant.yelp_id, restaurant.city, restaurant.state)
+    # stale Yelp photos are shown while a worker fetches new ones
+    photos, is_stale = get_gallery(restaurant)
+    if is_stale:
+        enqueue_job('yelp_photos', restaurant.rest_id)
 
-    if not photos:
-        results = business(yelp_id)
-        photos = results['photos']
+    ranking = get_ranking(restaurant.yelp_id, restaurant.city, restaurant.state)
 
     check_city = restaurant.city.upper() == session.get('city') and restaurant.state == session.get('state')
     
     lsts_to_add = []
     if check_city:
-        # fix so only displays lists with <20 items
         lsts_to_add = check_lists(restaurant.rest_id, session.get('user_id'))
 
     return render_template('restaurant.html', ranking=ranking,
@@ -549,8 +593,7 @@ def get_user_info():
     """Get user profile info."""
 
     username = request.args.get('username')
-    user = User.query.filter_by(username=username).first()
-    profile_info = user.profiles[0].to_dict()
+    profile_info = get_user_record(username=username).profile_dict()
 
     return jsonify(profile_info)
 
@@ -560,12 +603,23 @@ def get_user_profile_image():
     """Get user profile info."""
 
     username = request.args.get('username')
-    user = User.query.filter_by(username=username).first()
-    profile_image = user.profiles[0].image_fn
+    profile_image = get_user_record(username=username).image_fn
 
     return jsonify(profile_image)
 
 
+@app.route('/_debug/cache')
+def show_cache_stats():
+    """Show hit and miss counts for the in-process caches."""
+
+    if not (app.debug or app.testing):
+        abort(404)
+
+    return jsonify({'cities': cities_cache.stats(),
+                    'pages': page_cache.stats(),
+                    'users': user_cache.stats()})
+
+
 def allowed_file(filename):
     """Check if uploaded profile image is an allowed file type."""
     return '.' in filename and \
@@ -589,6 +643,8 @@ def update_profile_info():
 
     db.session.commit()
 
+    invalidate_user(user.user_id)
+
     user_dict = user.profiles[0].to_dict()
 
     file = request.files.get('image')
@@ -598,6 +654,7 @@ def update_profile_info():
         user.profiles[0].image_fn = filename
         file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
         db.session.commit()
+        invalidate_user(user.user_id)
         user_dict['filename'] = filename
 
     else:
@@ -610,7 +667,7 @@ def update_profile_info():
 def new_user_page_react(username):
     """User profile page with no lists expanded."""
 
-    user = get_user(username)
+    user = get_user_record(username=username)
 
     user_dict = {
         'city': user.city.title(),
@@ -625,7 +682,7 @@ def new_user_page_react(username):
 def new_list_react(username, listname):
     """User profile page with specific list expanded."""
 
-    user = get_user(username)
+    user = get_user_record(username=username)
     lst = List.query.filter(List.name == listname, List.user_id == user.user_id).first()
     user_dict = {
         'listname': listname.title(),
@@ -0,0 +1,178 @@
+"""In-memory index of favorites lists used to find the most similar local."""
+
+import threading
+
+from model import db, User, List, ListItem
+
+
+class CityFavorites(object):
+    """Favorites of every local in one city, stored as integer bitsets.
+
+    Each restaurant favorited in the city is assigned a bit position, and each
+    user's favorites list is a single int with those bits set, so comparing
+    two users is one AND plus a popcount.
+    """
+
+    def __init__(self):
+        self.bit_for_rest = {}
+        self.rest_for_bit = []
+        self.favorites = {}
+
+    def bit(self, rest_id):
+        """Return the bit mask for a restaurant, assigning one if needed."""
+
+        position = self.bit_for_rest.get(rest_id)
+
+        if position is None:
+            position = len(self.rest_for_bit)
+            self.bit_for_rest[rest_id] = position
+            self.rest_for_bit.append(rest_id)
+
+        return 1 << position
+
+    def bits_for(self, rest_ids):
+        """Return a bitset for an iterable of restaurant ids."""
+
+        bits = 0
+        for rest_id in rest_ids:
+            bits |= self.bit(rest_id)
+
+        return bits
+
+    def rest_ids(self, bits):
+        """Return sorted restaurant ids for the bits set in a bitset."""
+
+        rest_ids = []
+        position = 0
+
+        while bits:
+            if bits & 1:
+                rest_ids.append(self.rest_for_bit[position])
+            bits >>= 1
+            position += 1
+
+        return sorted(rest_ids)
+
+    def add(self, user_id, rest_id):
+        """Add a restaurant to a user's favorites."""
+
+        self.favorites[user_id] = self.favorites.get(user_id, 0) | self.bit(rest_id)
+
+    def remove(self, user_id, rest_id):
+        """Remove a restaurant from a user's favorites."""
+
+        if user_id in self.favorites and rest_id in self.bit_for_rest:
+            self.favorites[user_id] &= ~(1 << self.bit_for_rest[rest_id])
+
+    def most_similar(self, user_id, my_bits):
+        """Return (user_id, common bits) of the local with the most overlap.
+
+        Returns (None, 0) if no other local shares a favorite restaurant.
+        """
+
+        best_user_id = None
+        best_count = 0
+        best_common = 0
+
+        for other_id in sorted(self.favorites):
+            if other_id == user_id:
+                continue
+
+            common = self.favorites[other_id] & my_bits
+            count = bin(common).count('1')
+
+            if count > best_count:
+                best_user_id = other_id
+                best_count = count
+                best_common = common
+
+        return best_user_id, best_common
+
+
+_index = {}
+_lock = threading.Lock()
+
+
+def load_city_favorites(state, city):
+    """Build the favorites bitsets for a city with a single query."""
+
+    rows = (db.session.query(User.user_id, ListItem.rest_id)
+                      .select_from(User)
+                      .join(List)
+                      .join(ListItem)
+                      .filter(User.state == state,
+                              User.city == city,
+                              List.category_id == 1)
+                      .all())
+
+    city_favorites = CityFavorites()
+    for user_id, rest_id in rows:
+        city_favorites.add(user_id, rest_id)
+
+    return city_favorites
+
+
+def get_city_favorites(state, city):
+    """Get the favorites index for a city, loading it on first use.
+
+    The city is loaded while holding the lock, so a favorite saved during
+    the load waits in add_favorite or remove_favorite and is applied after.
+    """
+
+    key = (state, city)
+
+    with _lock:
+        city_favorites = _index.get(key)
+
+        if city_favorites is None:
+            city_favorites = _index[key] = load_city_favorites(state, city)
+
+    return city_favorites
+
+
+def add_favorite(state, city, user_id, rest_id):
+    """Record a new favorite for a local if that city is already indexed."""
+
+    with _lock:
+        city_favorites = _index.get((state, city))
+        if city_favorites is not None:
+            city_favorites.add(user_id, rest_id)
+
+
+def remove_favorite(state, city, user_id, rest_id):
+    """Drop a favorite for a local if that city is already indexed."""
+
+    with _lock:
+        city_favorites = _index.get((state, city))
+        if city_favorites is not None:
+            city_favorites.remove(user_id, rest_id)
+
+
+def reset_similarity_index():
+    """Forget all indexed cities so they are reloaded on next use."""
+
+    with _lock:
+        _index.clear()
+
+
+def find_most_similar(state, city, user_id, my_rest_ids):
+    """Return (user_id, common rest ids, uncommon rest ids) for a local.
+
+    The uncommon restaurants are the favorites of the similar user that are
+    not in my_rest_ids. Returns None if nobody in the city overlaps.
+    """
+
+    city_favorites = get_city_favorites(state, city)
+
+    with _lock:
+        my_bits = city_favorites.bits_for(my_rest_ids)
+        other_id, common = city_favorites.most_similar(user_id, my_bits)
+
+        if other_id is None:
+            return None
+
+        uncommon = city_favorites.favorites[other_id] & ~my_bits
+
+        return (other_id,
+                city_favorites.rest_ids(common),
+                city_favorites.rest_ids(uncommon))
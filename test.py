@@ -1,6 +1,35 @@
 from unittest import TestCase
+import json
+import os
+import tempfile
+import threading
 from server import app
-from model import connect_to_db, db, example_data
+from model import (connect_to_db, db, example_data, Restaurant, List, ListItem, Zipcode, User,
+                   Photo, Job, CityRestaurantCount)
+from auth import hash_rounds, verify_password
+from user_context import get_user_record, user_cache
+from counters import reconcile_counts, get_counter, USERS
+from search_index import CityRestaurants, reset_search_index
+from restaurant import (add_list_item, del_list_item, get_ranking, get_list_items_react,
+                        get_list_email_body, delete_list, delete_lists, delete_list_items,
+                        check_lists)
+from cities import count_restaurants_by_city
+from leaderboard import increment_city_count
+from locations import reload_locations, get_zipcode, parse_location_row
+from seed import load_zips
+import jobs
+import enrich
+import yelp_api
+from datetime import datetime, timedelta
+import migrations
+from query_plans import check_query_plans
+from query_stats import reset_stats
+from similarity import CityFavorites, find_most_similar, reset_similarity_index
+from yelp_api import YelpClient
+from cache import TTLCache
+from ig import parse_location_line, is_jpg
+from geo import haversine, best_match
+from sendgrid import EmailDispatcher, LocalSinkTransport, build_message
 
 
 class FlaskTests(TestCase):
@@ -10,10 +39,15 @@ class FlaskTests(TestCase):
 
         self.client = app.test_client()
         app.config['TESTING'] = True
+        app.config['BCRYPT_ROUNDS'] = 4
         connect_to_db(app, "postgresql:///testdb")
 
         db.create_all()
         example_data()
+        reload_locations()
+        user_cache.clear()
+        reset_search_index()
+        reset_similarity_index()
 
     def tearDown(self):
         """Do at end of every test."""
@@ -21,6 +55,42 @@ class FlaskTests(TestCase):
         db.session.close()
         db.drop_all()
 
+    def add_restaurant(self, name='La Ciccia', yelp_id='la-ciccia', lat=37.74, lng=-122.42,
+                       city='San Francisco', state='CA', **kwargs):
+        """Save a restaurant, La Ciccia unless told otherwise."""
+
+        rest = Restaurant(name=name, yelp_id=yelp_id, lat=lat, lng=lng,
+                          city=city, state=state, **kwargs)
+        db.session.add(rest)
+        db.session.commit()
+
+        return rest
+
+    def add_favorites(self, user_id=1):
+        """Save an empty favorites list for a user."""
+
+        lst = List(user_id=user_id, name='favorites', status='draft', category_id=1)
+        db.session.add(lst)
+        db.session.commit()
+
+        return lst
+
+    def stub_yelp(self, responses):
+        """Answer Yelp requests with responses, returning the stub transport."""
+
+        transport = StubTransport(responses)
+        self.addCleanup(setattr, yelp_api.client, 'transport', yelp_api.client.transport)
+        yelp_api.client.transport = transport
+        yelp_api.client.cache.clear()
+
+        return transport
+
+    def stub_fb_request(self, lookup):
+        """Answer Facebook place lookups with lookup(name, lat, lng, address)."""
+
+        self.addCleanup(setattr, enrich.fb, 'request', enrich.fb.request)
+        enrich.fb.request = lookup
+
     # LOGIN TESTS
     def test_correct_login(self):
         result = self.client.post('/login-user', data={'email': 'talyaacovi@gmail.com',
@@ -37,6 +107,27 @@ class FlaskTests(TestCase):
                                                        'password': 'password'})
         self.assertIn('No Account', result.data)
 
+    def test_login_rehashes_outdated_password(self):
+        data = {'email': 'talyaacovi@gmail.com', 'password': 'password'}
+
+        self.client.post('/login-user', data=data)
+        password = User.query.filter_by(email='talyaacovi@gmail.com').one().password
+        self.assertEqual(hash_rounds(password), 4)
+
+        app.config['BCRYPT_ROUNDS'] = 5
+        result = self.client.post('/login-user', data=data)
+        self.assertIn('"msg": "Success"', result.data)
+        password = User.query.filter_by(email='talyaacovi@gmail.com').one().password
+        self.assertEqual(hash_rounds(password), 5)
+
+    def test_plain_text_password_rejected(self):
+        User.query.get(1).password = 'password'
+        db.session.commit()
+
+        result = self.client.post('/login-user', data={'email': 'talyaacovi@gmail.com',
+                                                       'password': 'password'})
+        self.assertIn('Incorrect', result.data)
+
     # SIGNUP TESTS
     def test_signup(self):
         result = self.client.post('/signup', data={'email': 'alice@gmail.com',
@@ -52,11 +143,626 @@ class FlaskTests(TestCase):
                                                    'zipcode': '94117'})
         self.assertIn('', result.data)
 
+    def test_zipcode_check(self):
+        result = self.client.get('/check-zipcode?zipcode=94117')
+        self.assertEqual(result.data, 'True')
+        result = self.client.get('/check-zipcode?zipcode=00000')
+        self.assertEqual(result.data, 'False')
+
+    def test_load_zips_is_idempotent(self):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as f:
+            f.write('ZIP_CODE,CITY,STATE,LAT,LONG\n'
+                    '94103,SAN FRANCISCO,CA,37.7725,-122.4147\n'
+                    '94110,SAN FRANCISCO,CA,37.7509,-122.4153\n'
+                    '9411x,SAN FRANCISCO,CA,37.75,-122.41\n')
+
+        try:
+            self.assertEqual(load_zips(path), 2)
+            self.assertEqual(load_zips(path), 2)
+        finally:
+            os.remove(path)
+
+        reload_locations()
+        self.assertEqual(db.session.query(Zipcode).count(), 4)
+        self.assertEqual(get_zipcode('94103').lat, 37.7725)
+        self.assertEqual(get_zipcode('94110').city, 'SAN FRANCISCO')
+
     def test_homepage(self):
         result = self.client.get('/')
         self.assertEqual(result.status_code, 200)
         self.assertIn('<h1>Where do the locals eat?</h1>', result.data)
 
+    def test_homepage_cached(self):
+        self.client.get('/')
+        before = json.loads(self.client.get('/_debug/cache').data)['pages']
+        self.client.get('/')
+        after = json.loads(self.client.get('/_debug/cache').data)['pages']
+        self.assertEqual(after['hits'], before['hits'] + 1)
+
+    def test_query_stats_reported(self):
+        reset_stats()
+        result = self.client.get('/check-username?username=talyaac')
+        self.assertEqual(result.headers['X-Query-Count'], '1')
+
+        report = json.loads(self.client.get('/_debug/queries').data)
+        self.assertEqual(report['do_check_username']['max_queries'], 1)
+        self.assertFalse(report['do_check_username']['flagged'])
+
+    # CITY LEADERBOARD TESTS
+    def test_city_counts_follow_favorites(self):
+        rest = self.add_restaurant()
+        lst = self.add_favorites()
+
+        item = add_list_item(rest.rest_id, lst.list_id, 1)
+        top = count_restaurants_by_city('ca', 'san francisco')
+        self.assertEqual([(r.yelp_id, count) for r, count in top], [('la-ciccia', 1)])
+        self.assertEqual(get_ranking('la-ciccia', 'San Francisco', 'CA'), 1)
+
+        del_list_item(item.item_id)
+        self.assertEqual(count_restaurants_by_city('ca', 'san francisco'), [])
+        self.assertIsNone(get_ranking('la-ciccia', 'San Francisco', 'CA'))
+
+    def test_city_count_inserted_then_incremented(self):
+        rest = self.add_restaurant()
+
+        increment_city_count('CA', 'SAN FRANCISCO', rest.rest_id)
+        increment_city_count('CA', 'SAN FRANCISCO', rest.rest_id)
+        db.session.commit()
+
+        self.assertEqual([c.count for c in CityRestaurantCount.query.all()], [2])
+
+    def test_nearby_restaurants(self):
+        near = self.add_restaurant(lat=37.7422, lng=-122.4263)
+        far = self.add_restaurant('Canlis', 'canlis', 47.6430, -122.3467, 'Seattle', 'WA')
+        lst = self.add_favorites()
+
+        add_list_item(near.rest_id, lst.list_id, 1)
+        add_list_item(far.rest_id, lst.list_id, 1)
+
+        result = self.client.get('/nearby.json?lat=37.7425&lng=-122.4260&radius=1000')
+        restaurants = json.loads(result.data)['restaurants']
+        self.assertEqual([r['yelp_id'] for r in restaurants], ['la-ciccia'])
+        self.assertEqual(restaurants[0]['favorites'], 1)
+
+        result = self.client.get('/nearby.json?lat=north')
+        self.assertEqual(result.status_code, 400)
+
+        for query in ['radius=-5', 'radius=nan', 'limit=0', 'limit=-1']:
+            result = self.client.get('/nearby.json?lat=37.7425&lng=-122.4260&' + query)
+            self.assertEqual(result.status_code, 400, query)
+
+    def test_delete_list_removes_items_and_counts(self):
+        rest = self.add_restaurant()
+        lst = self.add_favorites()
+
+        add_list_item(rest.rest_id, lst.list_id, 1)
+
+        self.assertEqual(delete_list(lst.list_id), 'favorites has been deleted.')
+        self.assertEqual(ListItem.query.count(), 0)
+        self.assertEqual(count_restaurants_by_city('ca', 'san francisco'), [])
+
+    def test_bulk_deletes_take_favorites_out_of_city_counts(self):
+        ciccia = self.add_restaurant()
+        nopa = self.add_restaurant('Nopa', 'nopa', 37.77, -122.44)
+        tal_favorites = self.add_favorites(1)
+        logan_favorites = self.add_favorites(2)
+
+        for lst in [tal_favorites, logan_favorites]:
+            add_list_item(ciccia.rest_id, lst.list_id, lst.user_id)
+            item_id = add_list_item(nopa.rest_id, lst.list_id, lst.user_id).item_id
+
+        self.assertEqual(delete_lists([tal_favorites.list_id]), 1)
+        self.assertEqual(sorted((c.rest_id, c.count) for c in CityRestaurantCount.query),
+                         sorted([(ciccia.rest_id, 1), (nopa.rest_id, 1)]))
+
+        self.assertEqual(delete_list_items([item_id]), 1)
+        self.assertEqual([(c.rest_id, c.count) for c in CityRestaurantCount.query],
+                         [(ciccia.rest_id, 1)])
+
+    def test_user_record_cached_until_favorites_change(self):
+        rest = self.add_restaurant()
+        lst = self.add_favorites()
+
+        with app.test_request_context():
+            user = get_user_record(username='talyaac')
+            self.assertEqual(user.favorites_count, 0)
+            self.assertIs(get_user_record(user_id=1), user)
+
+            item_id = add_list_item(rest.rest_id, lst.list_id, 1).item_id
+            self.assertEqual(get_user_record(user_id=1).favorites_count, 1)
+
+        with app.test_request_context():
+            self.assertEqual(get_user_record(username='talyaac').favorites_count, 1)
+            del_list_item(item_id)
+            self.assertEqual(get_user_record(username='talyaac').favorites_count, 0)
+
+    # SIMILAR LOCALS TESTS
+    def test_most_similar_local_follows_list_items(self):
+        ciccia = self.add_restaurant()
+        nopa = self.add_restaurant('Nopa', 'nopa', 37.77, -122.44)
+        tal_favorites = self.add_favorites(1)
+        logan_favorites = self.add_favorites(2)
+        ciccia_id, nopa_id = ciccia.rest_id, nopa.rest_id
+
+        item_id = add_list_item(ciccia_id, tal_favorites.list_id, 1).item_id
+        add_list_item(ciccia_id, logan_favorites.list_id, 2)
+        add_list_item(nopa_id, logan_favorites.list_id, 2)
+
+        self.assertEqual(find_most_similar('CA', 'SAN FRANCISCO', 1, [ciccia_id]),
+                         (2, [ciccia_id], [nopa_id]))
+
+        # the city is indexed now, so these update it in place
+        add_list_item(nopa_id, tal_favorites.list_id, 1)
+        self.assertEqual(find_most_similar('CA', 'SAN FRANCISCO', 2, [ciccia_id, nopa_id]),
+                         (1, sorted([ciccia_id, nopa_id]), []))
+
+        del_list_item(item_id)
+        self.assertEqual(find_most_similar('CA', 'SAN FRANCISCO', 2, [ciccia_id, nopa_id]),
+                         (1, [nopa_id], []))
+
+        reset_similarity_index()
+        self.assertEqual(find_most_similar('CA', 'SAN FRANCISCO', 2, [ciccia_id, nopa_id]),
+                         (1, [nopa_id], []))
+        self.assertIsNone(find_most_similar('WA', 'SEATTLE', 3, [ciccia_id]))
+
+    # CITY PAGE TESTS
+    def test_city_page_queries_do_not_grow_with_locals(self):
+        rest = self.add_restaurant()
+        lst = self.add_favorites()
+        db.session.add_all([Photo(rest_id=rest.rest_id, url='/photo{}.jpg'.format(i))
+                            for i in range(4)])
+        db.session.commit()
+        add_list_item(rest.rest_id, lst.list_id, 1)
+
+        result = self.client.get('/cities/ca/san francisco')
+        self.assertIn('La Ciccia', result.data)
+        self.assertIn('/photo2.jpg', result.data)
+        self.assertNotIn('/photo3.jpg', result.data)
+        queries = result.headers['X-Query-Count']
+
+        db.session.add_all([User(email='local{}@gmail.com'.format(i), password='password',
+                                 username='local{}'.format(i), city='SAN FRANCISCO',
+                                 state='CA', zipcode='94103') for i in range(5)])
+        db.session.commit()
+
+        result = self.client.get('/cities/ca/san francisco')
+        self.assertIn('local4', result.data)
+        self.assertEqual(result.headers['X-Query-Count'], queries)
+
+    def test_check_lists_skips_lists_with_restaurant(self):
+        rest = self.add_restaurant()
+        favorites = self.add_favorites()
+        pizza = List(user_id=1, name='pizza', status='draft', category_id=2)
+        full = List(user_id=1, name='full', status='draft', category_id=2, item_count=20)
+        db.session.add_all([pizza, full])
+        db.session.commit()
+
+        item = add_list_item(rest.rest_id, favorites.list_id, 1)
+        self.assertEqual(List.query.get(favorites.list_id).item_count, 1)
+        self.assertEqual(check_lists(rest.rest_id, 1), [('pizza', pizza.list_id)])
+
+        del_list_item(item.item_id)
+        self.assertEqual(List.query.get(favorites.list_id).item_count, 0)
+        self.assertEqual(check_lists(rest.rest_id, 1),
+                         [('favorites', favorites.list_id), ('pizza', pizza.list_id)])
+
+    def test_favorites_counts_kept_and_reconciled(self):
+        rest = self.add_restaurant()
+        lst = self.add_favorites()
+
+        add_list_item(rest.rest_id, lst.list_id, 1)
+        self.assertEqual(User.query.get(1).favorites_count, 1)
+        self.assertEqual(reconcile_counts(), {'users': 0, 'lists': 0, 'user_count': 3})
+
+        User.query.get(2).favorites_count = 7
+        db.session.commit()
+        self.assertEqual(reconcile_counts()['users'], 1)
+        self.assertEqual(User.query.get(2).favorites_count, 0)
+
+        delete_list(lst.list_id)
+        self.assertEqual(User.query.get(1).favorites_count, 0)
+
+        self.client.post('/signup', data={'email': 'alice@gmail.com',
+                                          'password': 'password',
+                                          'username': 'alice',
+                                          'zipcode': '94117'})
+        self.assertEqual(get_counter(USERS), 4)
+
+    # LIST ITEM TESTS
+    def test_list_items_match_item_dicts(self):
+        rest = self.add_restaurant('Liholiho Yacht Club', 'liholiho', 37.7886, -122.4152)
+        lst = self.add_favorites()
+
+        item = add_list_item(rest.rest_id, lst.list_id, 1)
+
+        self.assertEqual(get_list_items_react(lst.list_id),
+                         {'restaurants': [item.to_dict()]})
+
+    def test_list_email_keeps_order(self):
+        self.add_restaurant('The Morris', 'the-morris', 37.76, -122.41,
+                            yelp_url='https://www.yelp.com/biz/the-morris')
+        self.add_restaurant(yelp_url='https://www.yelp.com/biz/la-ciccia')
+
+        with app.test_request_context():
+            body = get_list_email_body(['la-ciccia', 'the-morris'])
+
+        self.assertIn('1. <a href="https://www.yelp.com/biz/la-ciccia">La Ciccia</a>', body)
+        self.assertIn('2. <a href="https://www.yelp.com/biz/the-morris">The Morris</a>', body)
+
+    # SCHEMA TESTS
+    def test_hot_queries_use_indexes(self):
+        self.assertEqual(check_query_plans(), {})
+
+    def test_migrations_roll_back_and_reapply(self):
+        def drop_schema_migrations():
+            db.session.execute('DROP TABLE IF EXISTS schema_migrations')
+            db.session.commit()
+
+        drop_schema_migrations()
+        self.addCleanup(drop_schema_migrations)
+
+        migrations.stamp()
+        self.assertEqual(migrations.downgrade(0), [7, 6, 5, 4, 3, 2, 1])
+
+        User.query.filter_by(username='fred').update({User.password: 'password'})
+        db.session.commit()
+
+        self.assertEqual(migrations.upgrade(), [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(migrations.get_current_version(), migrations.LATEST)
+        self.assertTrue(verify_password('password', User.query.filter_by(username='fred').one().password))
+        self.assertEqual(check_query_plans(), {})
+
+    # JOB QUEUE TESTS
+    def test_job_queue_dedupes_and_retries(self):
+        rest = self.add_restaurant('The Morris', 'the-morris', 37.76, -122.41)
+
+        calls = []
+
+        def flaky(rest_id):
+            calls.append(rest_id)
+            if len(calls) == 1:
+                raise ValueError('scraper failed')
+
+        self.addCleanup(setattr, jobs, 'RETRY_DELAY', jobs.RETRY_DELAY)
+        self.addCleanup(jobs.HANDLERS.pop, 'test')
+        jobs.HANDLERS['test'] = flaky
+        jobs.RETRY_DELAY = 0
+
+        job = jobs.enqueue_job('test', rest.rest_id)
+        self.assertEqual(jobs.enqueue_job('test', rest.rest_id).job_id, job.job_id)
+
+        self.assertEqual(jobs.run_job(jobs.claim_job()), 'queued')
+        self.assertEqual(jobs.run_job(jobs.claim_job()), 'done')
+        self.assertEqual(calls, [rest.rest_id, rest.rest_id])
+        self.assertIsNone(jobs.claim_job())
+
+    def test_yelp_photos_stored_and_refreshed(self):
+        rest = self.add_restaurant()
+
+        transport = self.stub_yelp([StubResponse(200, {'photos': ['/old.jpg']}),
+                                    StubResponse(200, {'photos': ['/new.jpg']})])
+
+        self.assertIn('/old.jpg', self.client.get('/restaurants/la-ciccia').data)
+        self.assertIn('/old.jpg', self.client.get('/restaurants/la-ciccia').data)
+        self.assertEqual(len(transport.calls), 1)
+        self.assertIsNone(jobs.get_latest_job('yelp_photos', rest.rest_id))
+
+        Photo.query.update({Photo.fetched_at: datetime.utcnow() - timedelta(days=30)})
+        db.session.commit()
+        yelp_api.client.cache.clear()
+
+        self.assertIn('/old.jpg', self.client.get('/restaurants/la-ciccia').data)
+        self.assertEqual(jobs.run_job(jobs.claim_job()), 'done')
+        self.assertEqual([(p.url, p.source) for p in Photo.query.all()], [('/new.jpg', 'yelp')])
+
+    def test_empty_yelp_gallery_not_refetched_every_view(self):
+        rest = self.add_restaurant()
+
+        transport = self.stub_yelp([StubResponse(200, {'photos': []}),
+                                    StubResponse(200, {'photos': []}),
+                                    StubResponse(200, {'photos': ['/new.jpg']})])
+
+        for _ in range(3):
+            self.assertEqual(self.client.get('/restaurants/la-ciccia').status_code, 200)
+        self.assertEqual(len(transport.calls), 1)
+        self.assertEqual(jobs.get_latest_job('yelp_photos', rest.rest_id).status, 'queued')
+
+        yelp_api.client.cache.clear()
+        self.assertEqual(jobs.run_job(jobs.claim_job()), 'done')
+        self.assertEqual(len(transport.calls), 2)
+
+        Job.query.update({Job.created_at: datetime.utcnow() - timedelta(days=2)})
+        db.session.commit()
+        yelp_api.client.cache.clear()
+
+        self.assertIn('/new.jpg', self.client.get('/restaurants/la-ciccia').data)
+        self.assertEqual(len(transport.calls), 3)
+
+    # SEARCH TESTS
+    def test_search_results_local_before_yelp(self):
+        self.add_restaurant(yelp_category='Italian', address='291 30th St')
+
+        transport = self.stub_yelp([StubResponse(200, {'businesses': [
+            {'name': 'Taqueria Cancun', 'id': 'taqueria-cancun',
+             'location': {'display_address': ['2288 Mission St']}}]})])
+
+        result = self.client.get('/search-results.json?term=La+Cic&username=talyaac')
+        self.assertEqual(json.loads(result.data)['rests'],
+                         [{'name': 'La Ciccia', 'id': 'la-ciccia', 'location': '291 30th St'}])
+        self.assertEqual(transport.calls, [])
+
+        for _ in range(2):
+            result = self.client.get('/search-results.json?term=Taqueria&username=talyaac')
+            self.assertEqual(json.loads(result.data)['rests'][0]['id'], 'taqueria-cancun')
+        self.assertEqual(len(transport.calls), 1)
+
+    # HOT AND NEW TESTS
+    def test_hot_and_new_waits_for_lookups(self):
+        self.stub_fb_request(lambda name, lat, lng, address=None: '1234')
+
+        with app.test_request_context():
+            hot_and_new = enrich.get_hot_and_new([business_result('nopa')])
+
+        self.assertEqual(hot_and_new[0]['ig_loc_id'], '1234')
+        db.session.expire_all()
+        self.assertEqual(Restaurant.query.filter_by(yelp_id='nopa').one().ig_loc_id, '1234')
+
+    def test_hot_and_new_renders_without_slow_lookups(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.addCleanup(setattr, enrich, 'LOOKUP_WAIT', enrich.LOOKUP_WAIT)
+        enrich.LOOKUP_WAIT = 0.1
+        self.stub_fb_request(lambda name, lat, lng, address=None: release.wait(5) and None)
+
+        with app.test_request_context():
+            hot_and_new = enrich.get_hot_and_new([business_result('nopa')])
+
+        self.assertIsNone(hot_and_new[0]['ig_loc_id'])
+        self.assertEqual(Restaurant.query.filter_by(yelp_id='nopa').count(), 1)
+
+    def test_hot_and_new_reuses_saved_restaurants(self):
+        self.add_restaurant('Nopa', 'nopa', 37.77, -122.44, ig_loc_id='5678')
+
+        lookups = []
+        self.stub_fb_request(lambda name, lat, lng, address=None: lookups.append(name))
+
+        with app.test_request_context():
+            hot_and_new = enrich.get_hot_and_new([business_result('nopa')])
+
+        self.assertEqual(hot_and_new[0]['ig_loc_id'], '5678')
+        self.assertEqual(Restaurant.query.filter_by(yelp_id='nopa').count(), 1)
+        self.assertEqual(lookups, [])
+
+
+def business_result(yelp_id):
+    """Get a Yelp search result for a San Francisco restaurant."""
+
+    return {'name': yelp_id.title(), 'id': yelp_id,
+            'coordinates': {'latitude': 37.77, 'longitude': -122.44},
+            'url': 'https://www.yelp.com/biz/{}?adjust_creative=x'.format(yelp_id),
+            'categories': [{'title': 'American', 'alias': 'newamerican'}],
+            'image_url': 'https://s3.yelp.com/{}.jpg'.format(yelp_id),
+            'location': {'address1': '560 Divisadero St', 'city': 'San Francisco',
+                         'state': 'CA'}}
+
+
+class SearchIndexTests(TestCase):
+
+    def setUp(self):
+        self.index = CityRestaurants()
+        self.index.add(1, 'liholiho', 'Liholiho Yacht Club', 'Hawaiian', '871 Sutter St')
+        self.index.add(2, 'la-ciccia', 'La Ciccia', 'Italian', '291 30th St')
+
+    def test_word_prefixes_match(self):
+        self.assertEqual([r['id'] for r in self.index.search('liho')], ['liholiho'])
+        self.assertEqual([r['id'] for r in self.index.search('yacht cl')], ['liholiho'])
+        self.assertEqual([r['id'] for r in self.index.search('ital')], ['la-ciccia'])
+        self.assertEqual(self.index.search('ciccia club'), [])
+        self.assertEqual(self.index.search('icci'), [])
+
+    def test_removed_restaurant_not_found(self):
+        self.index.remove(1)
+        self.assertEqual(self.index.search('liholiho'), [])
+
+
+class SimilarityTests(TestCase):
+
+    def test_most_similar_local(self):
+        city_favorites = CityFavorites()
+        for rest_id in [1, 2, 3]:
+            city_favorites.add(1, rest_id)
+        for rest_id in [2, 3, 4]:
+            city_favorites.add(2, rest_id)
+        city_favorites.add(3, 5)
+
+        my_bits = city_favorites.bits_for([1, 2, 3])
+        user_id, common = city_favorites.most_similar(1, my_bits)
+        self.assertEqual(user_id, 2)
+        self.assertEqual(city_favorites.rest_ids(common), [2, 3])
+
+    def test_removed_favorite_not_matched(self):
+        city_favorites = CityFavorites()
+        city_favorites.add(1, 1)
+        city_favorites.add(2, 1)
+        city_favorites.remove(2, 1)
+
+        my_bits = city_favorites.bits_for([1])
+        self.assertEqual(city_favorites.most_similar(1, my_bits), (None, 0))
+
+
+class CacheTests(TestCase):
+
+    def test_peek_does_not_count(self):
+        cache = TTLCache(max_size=2)
+        cache.set('a', 1)
+
+        self.assertEqual(cache.peek('a'), 1)
+        self.assertIsNone(cache.peek('b'))
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (0, 0))
+
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+
+
+class StubResponse(object):
+
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.headers = {}
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class StubTransport(object):
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append(url)
+        return self.responses.pop(0)
+
+
+class YelpClientTests(TestCase):
+
+    def test_retries_rate_limit_then_caches(self):
+        transport = StubTransport([StubResponse(429, {}),
+                                   StubResponse(200, {'name': 'Liholiho'})])
+        client = YelpClient('key', transport=transport, backoff=0)
+
+        self.assertEqual(client.request('/v3/businesses/liholiho'), {'name': 'Liholiho'})
+        self.assertEqual(client.request('/v3/businesses/liholiho'), {'name': 'Liholiho'})
+        self.assertEqual(len(transport.calls), 2)
+
+    def test_errors_are_not_cached(self):
+        transport = StubTransport([StubResponse(404, {'error': {}}),
+                                   StubResponse(200, {'name': 'Liholiho'})])
+        client = YelpClient('key', transport=transport, backoff=0)
+
+        self.assertIn('error', client.request('/v3/businesses/liholiho'))
+        self.assertEqual(client.request('/v3/businesses/liholiho'), {'name': 'Liholiho'})
+
+    def test_retry_after_is_capped(self):
+        client = YelpClient('key', transport=StubTransport([]))
+        response = StubResponse(429, {})
+
+        response.headers['Retry-After'] = '2'
+        self.assertEqual(client.retry_delay(0, response), 2)
+
+        response.headers['Retry-After'] = '86400'
+        self.assertEqual(client.retry_delay(0, response), yelp_api.MAX_RETRY_WAIT)
+
+
+class InstagramParsingTests(TestCase):
+
+    def test_parse_location_line(self):
+        line = ('location-id: 215, title: La Ciccia, subtitle: 291 30th St, '
+                'city: San Francisco, lat: 37.7422, lng: -122.4263\n')
+        self.assertEqual(parse_location_line(line),
+                         {'loc_id': '215', 'name': 'La Ciccia', 'address': '291 30th St',
+                          'city': 'San Francisco', 'lat': '37.7422',
+                          'lng': '-122.4263'})
+
+    def test_unparseable_line_skipped(self):
+        self.assertIsNone(parse_location_line('Searching for location...\n'))
+
+    def test_is_jpg_ignores_query_string(self):
+        self.assertTrue(is_jpg('https://scontent.cdninstagram.com/a.jpg?ig_cache_key=1'))
+        self.assertFalse(is_jpg('https://scontent.cdninstagram.com/a.mp4'))
+
+
+class LocationParsingTests(TestCase):
+
+    def test_parse_location_row(self):
+        self.assertEqual(parse_location_row(['501', 'Holtsville', 'ny', '40.8154', '-73.0451']),
+                         ('501', 'HOLTSVILLE', 'NY', 40.8154, -73.0451))
+
+    def test_invalid_rows_rejected(self):
+        self.assertIsNone(parse_location_row(['ZIP_CODE', 'CITY', 'STATE', 'LAT', 'LONG']))
+        self.assertIsNone(parse_location_row(['94103', 'SAN FRANCISCO', 'CA', '', '-122.41']))
+        self.assertIsNone(parse_location_row(['94103', 'SAN FRANCISCO', 'CA', '137.77', '-122.41']))
+        self.assertIsNone(parse_location_row(['94103', 'SAN FRANCISCO', 'CA']))
+
+
+class GeoMatchingTests(TestCase):
+
+    def test_haversine(self):
+        # SF Ferry Building to Coit Tower is about 1.3 km
+        distance = haversine(37.7955, -122.3937, 37.8024, -122.4058)
+        self.assertAlmostEqual(distance, 1300, delta=100)
+
+    def test_best_match_prefers_close_similar_name(self):
+        candidates = [{'name': 'Liholiho Yacht Club', 'lat': '37.7886', 'lng': '-122.4152'},
+                      {'name': 'Liholiho Yacht Club', 'lat': '37.7986', 'lng': '-122.4152'},
+                      {'name': 'Sushi Place', 'lat': '37.7886', 'lng': '-122.4152'}]
+        match = best_match(candidates, 'Liholiho Yacht Club', 37.78862, -122.41518)
+        self.assertIs(match, candidates[0])
+
+    def test_best_match_none_out_of_radius(self):
+        candidates = [{'name': 'The Morris', 'lat': '37.80', 'lng': '-122.41'}]
+        self.assertIsNone(best_match(candidates, 'The Morris', 37.76, -122.41))
+
+
+class EmailDispatcherTests(TestCase):
+
+    def test_same_message_batched_into_one_call(self):
+        transport = LocalSinkTransport()
+        dispatcher = EmailDispatcher(transport, autostart=False)
+
+        for to_email in ['a@example.com', 'b@example.com']:
+            dispatcher.enqueue(build_message(to_email, 'talyaacovi@gmail.com', 'Tal',
+                                             'Top Restaurants In SF', 'body',
+                                             {'-city-': 'SF'}, 'template'))
+        dispatcher.enqueue(build_message('c@example.com', 'talyaacovi@gmail.com', 'Tal',
+                                         'Restaurant List', 'other body',
+                                         {'-city-': 'SF'}, 'template'))
+        dispatcher.send_pending()
+
+        self.assertEqual(len(transport.sent), 2)
+        self.assertEqual([p['to'][0]['email'] for p in transport.sent[0]['personalizations']],
+                         ['a@example.com', 'b@example.com'])
+
+    def test_retries_server_errors(self):
+        statuses = [503, 202]
+
+        class FlakyTransport(object):
+            def send(self, payload):
+                return statuses.pop(0)
+
+        dispatcher = EmailDispatcher(FlakyTransport(), backoff=0, autostart=False)
+        message = build_message('a@example.com', 'talyaacovi@gmail.com', 'Tal',
+                                'Restaurant List', 'body', {}, 'template')
+
+        self.assertTrue(dispatcher.send_with_retries(message))
+        self.assertEqual(statuses, [])
+
+    def test_transport_error_does_not_stop_sender(self):
+        sent = []
+
+        class BrokenTransport(object):
+            def send(self, payload):
+                if not sent:
+                    sent.append(None)
+                    raise TypeError('no API key')
+                sent.append(payload)
+                return 202
+
+        dispatcher = EmailDispatcher(BrokenTransport(), batch_wait=0)
+
+        for subject in ['Restaurant List', 'Top Restaurants In SF']:
+            dispatcher.enqueue(build_message('a@example.com', 'talyaacovi@gmail.com', 'Tal',
+                                             subject, 'body', {}, 'template'))
+            dispatcher.wait_until_sent()
+
+        self.assertTrue(dispatcher._thread.is_alive())
+        self.assertEqual(sent[1]['subject'], 'Top Restaurants In SF')
+
 if __name__ == '__main__':
     # If called like a script, run our tests
     import unittest
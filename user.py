@@ -2,8 +2,10 @@
 
 from model import *
 from flask import session
-from sqlalchemy import func
-import bcrypt
+from locations import get_zipcode
+from auth import authenticate, hash_password
+from user_context import get_user_record, invalidate_user
+from counters import increment_counter, USERS
 
 
 def check_email(user_email):
@@ -17,9 +19,9 @@ def check_email(user_email):
 def check_password(user_email, user_password):
     """Check password when user logs in."""
 
-    password = User.query.filter_by(email=user_email).first().password
+    user, is_valid = authenticate(user_email, user_password)
 
-    if bcrypt.checkpw(user_password.encode('utf-8'), password.encode('utf-8')):
+    if is_valid:
         return True
 
 
@@ -35,7 +37,7 @@ def check_username(username):
 def check_zipcode(zipcode):
     """Check if zipcode is valid."""
 
-    if Zipcode.query.filter_by(zipcode=zipcode).first():
+    if get_zipcode(zipcode):
         return True
     else:
         return False
@@ -70,23 +72,25 @@ def get_user(username):
 def get_user_location(username):
     """Get city and state for a username."""
 
-    return db.session.query(User.city, User.state).filter(User.username == username).first()
+    user = get_user_record(username=username)
+
+    return user.city, user.state
 
 
 def register_user(email, password, username, zipcode):
     """Add a new user."""
 
-    city = Zipcode.query.filter_by(zipcode=zipcode).first().city
-    state = Zipcode.query.filter_by(zipcode=zipcode).first().state
+    location = get_zipcode(zipcode)
+    city = location.city
+    state = location.state
 
-    pw = password
-    hashed = bcrypt.hashpw(pw.encode('utf8'), bcrypt.gensalt())
-    print hashed
+    hashed = hash_password(password)
 
     user = User(email=email, password=hashed, username=username,
                 city=city, state=state, zipcode=zipcode)
 
     db.session.add(user)
+    increment_counter(USERS)
     db.session.commit()
 
     return user
@@ -100,19 +104,15 @@ def default_profile_info(user_id):
     db.session.add(profile)
     db.session.commit()
 
+    invalidate_user(user_id)
+
 
 def check_active(username):
     """Check if user is active."""
 
-    favorites = (db.session.query(User.username, func.count(ListItem.item_id))
-                           .join(List)
-                           .join(ListItem)
-                           .filter(User.username == username,
-                                   List.category_id == 1)
-                           .group_by(User.username)
-                           .all())
+    user = get_user_record(username=username)
 
-    if favorites and int(favorites[0][1]) >= 5:
+    if user and user.favorites_count >= 5:
         return 'True'
     else:
         return 'False'
@@ -121,14 +121,9 @@ def check_active(username):
 def check_user_id(user_id):
     """Check if user has at least 5 restaurants in Favorites list."""
 
-    favorites = (db.session.query(ListItem.item_id)
-                           .join(List)
-                           .join(User)
-                           .filter(User.user_id == user_id,
-                                   List.category_id == 1)
-                           .count())
+    user = get_user_record(user_id=user_id)
 
-    if int(favorites) >= 5:
+    if user and user.favorites_count >= 5:
         return 'True'
     else:
         return 'False'
@@ -0,0 +1,122 @@
+"""User, profile and favorites count lookups cached per request and process.
+
+Pages look the same user up several times per request, so records are kept
+on flask.g for the rest of the request, and in a short-lived process cache
+so the next few requests skip the database too. Records are plain tuples,
+not ORM objects, so they are safe to share between threads. Anything that
+changes a user's profile or favorites must call invalidate_user().
+
+The process cache is per worker, and invalidate_user() only clears the
+worker that made the change. Other workers can serve a record, including
+its favorites_count, up to USER_CACHE_TTL seconds old, so gates on that
+count (like /discover) may lag a recent favorite by that long.
+"""
+
+from collections import namedtuple
+from flask import g, session, has_request_context
+from model import db, User, Profile
+from cache import TTLCache
+
+
+USER_CACHE_TTL = 30
+
+user_cache = TTLCache(max_size=1024, ttl=USER_CACHE_TTL)
+
+
+class UserRecord(namedtuple('UserRecord', ['user_id', 'username', 'email', 'city',
+                                           'state', 'zipcode', 'image_fn', 'fav_rest',
+                                           'fav_dish', 'fav_city', 'favorites_count'])):
+    """Read-only snapshot of a user, their profile and favorites count."""
+
+    __slots__ = ()
+
+    def profile_dict(self):
+        """Return dict of profile info, like Profile.to_dict()."""
+
+        return {'fav_rest': self.fav_rest,
+                'fav_dish': self.fav_dish,
+                'fav_city': self.fav_city}
+
+
+def load_user_record(criterion):
+    """Get UserRecord for the user matching criterion in one query, or None."""
+
+    row = (db.session.query(User.user_id, User.username, User.email, User.city,
+                            User.state, User.zipcode, Profile.image_fn,
+                            Profile.fav_rest, Profile.fav_dish, Profile.fav_city,
+                            User.favorites_count)
+                     .outerjoin(Profile)
+                     .filter(criterion)
+                     .order_by(Profile.profile_id)
+                     .first())
+
+    if row:
+        return UserRecord(*row)
+
+
+def _request_records():
+    """Get this request's identity map, or None outside a request."""
+
+    if not has_request_context():
+        return None
+
+    if 'user_records' not in g:
+        g.user_records = {}
+
+    return g.user_records
+
+
+def get_user_record(user_id=None, username=None):
+    """Get UserRecord by user_id or username, or None if there is no such user."""
+
+    records = _request_records()
+    key = ('user_id', int(user_id)) if user_id is not None else ('username', username)
+
+    if records is not None and key in records:
+        return records[key]
+
+    if user_id is None:
+        user_id = user_cache.get(('username', username))
+
+    record = user_cache.get(('user_id', int(user_id))) if user_id is not None else None
+
+    if record is None:
+        if user_id is not None:
+            record = load_user_record(User.user_id == user_id)
+        else:
+            record = load_user_record(User.username == username)
+
+        if record is None:
+            return None
+
+        user_cache.set(('user_id', record.user_id), record)
+        user_cache.set(('username', record.username), record.user_id)
+
+    if records is not None:
+        records[('user_id', record.user_id)] = record
+        records[('username', record.username)] = record
+
+    return record
+
+
+def get_current_user():
+    """Get UserRecord for the logged in user, or None."""
+
+    user_id = session.get('user_id')
+
+    if user_id is None:
+        return None
+
+    return get_user_record(user_id=user_id)
+
+
+def invalidate_user(user_id):
+    """Forget cached records for a user after their profile or lists change."""
+
+    user_cache.delete(('user_id', int(user_id)))
+
+    records = _request_records()
+    if records:
+        for key, record in records.items():
+            if record.user_id == int(user_id):
+                del records[key]
@@ -1,8 +1,12 @@
 """Yelp API helper functions."""
 
+import logging
 import os
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from urllib import quote
+from cache import TTLCache
 
 API_KEY = os.environ['YELP_API_KEY']
 
@@ -13,58 +17,145 @@ BUSINESS_PATH = '/v3/businesses/'
 
 SEARCH_LIMIT = 5
 
+TIMEOUT = (3.05, 10)
+MAX_RETRIES = 3
+BACKOFF = 0.5
+# longest a request thread sleeps between retries, whatever Retry-After says
+MAX_RETRY_WAIT = 5
+CACHE_SIZE = 512
+CACHE_TTL = 600
+BUSINESS_CACHE_TTL = 3600
 
-def request(host, path, api_key, url_params=None):
-    """Make request to Yelp Fusion API."""
-    url_params = url_params or {}
-    # url = '{0}{1}'.format(host, quote(path.encode('utf8')))
-    # url = 'https://api.yelp.com/v3/businesses/search'
-    url = '{}{}'.format(host, quote(path.encode('utf8')))
-    # to authenticate API calls with the API key,
-    # set the authorization HTTP header value as Bearer API_KEY
-    headers = {
-        'Authorization': 'Bearer %s' % api_key,
-    }
-    print(u'Querying {0} ...'.format(url))
+logger = logging.getLogger(__name__)
+
+
+def make_session(pool_size=10):
+    """Create a requests Session that keeps connections to Yelp alive."""
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+class YelpClient(object):
+    """Client for the Yelp Fusion API.
+
+    Requests go through transport, which is a pooled requests Session unless
+    another object with the same request(method, url, **kwargs) method is
+    passed in (host can also point at a local stub server). 429s, 5xxs and
+    connection errors are retried with exponential backoff, and successful
+    responses are cached by path and params.
+    """
+
+    def __init__(self, api_key, host=API_HOST, transport=None, timeout=TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF, cache=None):
+        self.api_key = api_key
+        self.host = host
+        self.transport = transport or make_session()
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache = cache if cache is not None else TTLCache(max_size=CACHE_SIZE,
+                                                              ttl=CACHE_TTL)
+
+    def retry_delay(self, attempt, response=None):
+        """Seconds to wait before a retry, honoring Retry-After if sent.
+
+        Never more than MAX_RETRY_WAIT.
+        """
+
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), MAX_RETRY_WAIT)
+
+        return min(self.backoff * (2 ** attempt), MAX_RETRY_WAIT)
 
-    response = requests.request('GET', url, headers=headers, params=url_params)
+    def send(self, url, headers, url_params):
+        """Make GET request, retrying rate limits and transient failures."""
 
-    return response.json()
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.transport.request('GET', url,
+                                                  headers=headers,
+                                                  params=url_params,
+                                                  timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                logger.warning('Yelp request to %s failed, retrying', url)
+                time.sleep(self.retry_delay(attempt))
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                if attempt < self.max_retries:
+                    logger.warning('Yelp returned %s for %s, retrying',
+                                   response.status_code, url)
+                    time.sleep(self.retry_delay(attempt, response))
+                    continue
+
+            return response
+
+    def request(self, path, url_params=None, ttl=None):
+        """Make request to Yelp Fusion API."""
+
+        url_params = url_params or {}
+        cache_key = (path, tuple(sorted(url_params.items())))
+
+        results = self.cache.get(cache_key)
+        if results is not None:
+            return results
+
+        url = '{}{}'.format(self.host, quote(path.encode('utf8')))
+        # to authenticate API calls with the API key,
+        # set the authorization HTTP header value as Bearer API_KEY
+        headers = {
+            'Authorization': 'Bearer %s' % self.api_key,
+        }
+        logger.debug(u'Querying {0} ...'.format(url))
+
+        response = self.send(url, headers, url_params)
+        results = response.json()
+
+        if response.ok:
+            self.cache.set(cache_key, results, ttl)
+
+        return results
+
+
+client = YelpClient(API_KEY)
 
 
 def search(term, location):
     """Query the Search endpoint of the Yelp Fusion API."""
 
-    api_key = API_KEY
-
     url_params = {
         'term': term.replace(' ', '+'),
         'location': location.replace(' ', '+'),
         'limit': SEARCH_LIMIT,
         'categories': 'restaurants,food,nightlife'
     }
-    return request(API_HOST, SEARCH_PATH, api_key, url_params=url_params)
+    return client.request(SEARCH_PATH, url_params=url_params)
 
 
 def search_hot_new(location, categories):
     """Query the Search endpoint of Yelp Fusion API with 'hot and new' flag."""
 
-    api_key = API_KEY
-
     url_params = {
         'location': location.replace(' ', '+'),
         'limit': 10,
         'attributes': 'hot_and_new',
         'categories': categories
     }
-    return request(API_HOST, SEARCH_PATH, api_key, url_params=url_params)
+    return client.request(SEARCH_PATH, url_params=url_params)
 
 
 def business(business_id):
     """Query the Business endpoint of the Yelp Fusion API."""
 
-    api_key = API_KEY
-
     business_path = BUSINESS_PATH + business_id
 
-    return request(API_HOST, business_path, api_key)
+    return client.request(business_path, ttl=BUSINESS_CACHE_TTL)